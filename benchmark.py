@@ -0,0 +1,182 @@
+import os
+import json
+import math
+import argparse
+import resource
+import tempfile
+import itertools
+from time import perf_counter
+from multiprocessing import get_context
+
+import numpy as np
+
+# torch is imported by the functions that need it, so the process of a numpy configuration never loads it and its
+# peak RSS is the one of the torch-free runtime
+from numpy_engine import Numpy_FFTNet
+
+parser = argparse.ArgumentParser(description='FFTNet generation benchmark.')
+parser.add_argument('--radixs', nargs='+', type=int, default=[2, 4, 8], help='radix of every layer.')
+parser.add_argument('--depths', nargs='+', type=int, default=None,
+                    help='number of layers, default: enough layers to cover --receptive_field.')
+parser.add_argument('--receptive_field', type=int, default=2048)
+parser.add_argument('--fft_channels', nargs='+', type=int, default=[128])
+parser.add_argument('--transpose', nargs='+', type=int, default=[0], help='0: FFTNet, 1: transposed FFTNet.')
+parser.add_argument('--predict_dist', nargs='+', type=int, default=[1])
+parser.add_argument('--batch_size', nargs='+', type=int, default=[1])
+parser.add_argument('--threads', nargs='+', type=int, default=[1])
+parser.add_argument('--engines', nargs='+', default=['reference', 'incremental', 'int8', 'numpy'],
+                    help='reference: general_FFTNet.one_sample_generate, incremental: Incremental_FFTNet, '
+                         'int8: quantized Incremental_FFTNet, numpy: Numpy_FFTNet.')
+parser.add_argument('--aux_channels', type=int, default=26)
+parser.add_argument('--classes', type=int, default=256)
+parser.add_argument('--warmup', type=int, default=50, help='number of steps before timing.')
+parser.add_argument('--steps', type=int, default=500, help='number of timed steps.')
+parser.add_argument('--outfile', type=str, default=None, help='write the results to this JSON file.')
+
+
+def _build_net(config):
+    import torch
+    from models import general_FFTNet
+
+    torch.manual_seed(0)
+    return general_FFTNet([config['radix']] * config['depth'], config['fft_channels'], config['classes'],
+                          aux_channels=config['aux_channels'], transpose=bool(config['transpose']),
+                          predict_dist=config['predict_dist']).eval()
+
+
+def _numpy_step_fn(config):
+    # the weights are exported by the parent process, see export_numpy_weights
+    B, p = config['batch_size'], config['predict_dist']
+    T = (config['warmup'] + config['steps']) * p
+    engine = Numpy_FFTNet(config['weights'])
+    engine.init_buf(B)
+    engine.condition(np.random.RandomState(0).randn(B, config['aux_channels'], T).astype(np.float32))
+    state = {'samples': np.zeros((B, p), dtype=np.int64)}
+
+    def step():
+        state['samples'] = engine.sample(engine.step(state['samples']), 2.)
+
+    return step
+
+
+def _step_fn(config):
+    # build a random model and return a function running one generation step of the configured engine
+    if config['engine'] == 'numpy':
+        return _numpy_step_fn(config)
+
+    import torch
+    import torch.nn.functional as F
+    from incremental import Incremental_FFTNet
+
+    torch.set_num_threads(config['threads'])
+    torch.set_grad_enabled(False)
+    net = _build_net(config)
+    B, p = config['batch_size'], config['predict_dist']
+    T = (config['warmup'] + config['steps']) * p
+    h = torch.randn(B, config['aux_channels'], T)
+    state = {'samples': torch.zeros(B, p, dtype=torch.long), 't': 0}
+
+    if config['engine'] == 'reference':
+        r_field = net.get_receptive_field()
+        h = F.pad(h, (r_field, 0))
+        net.init_buf(B)
+
+        def step():
+            state['t'] += p
+            state['samples'] = net.one_sample_generate(state['samples'], h=h[:, :, :r_field + state['t']], c=2.)
+    else:
+        engine = Incremental_FFTNet(net)
+        if config['engine'] == 'int8':
+            engine = engine.quantized()
+        engine.init_buf(B)
+        engine.condition(h)
+
+        def step():
+            state['samples'] = engine.sampler(engine.step(state['samples']), 2.)
+
+    return step
+
+
+def export_numpy_weights(config, filename):
+    # the same random model as the torch engines, built in a process of its own so the parent never imports torch
+    from numpy_engine import export_weights
+
+    export_weights(_build_net(config), filename)
+
+
+def peak_rss_mb():
+    # VmHWM is the peak of this process alone, ru_maxrss also carries over the peak of the parent on linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_config(config):
+    step = _step_fn(config)
+    a = perf_counter()
+    for _ in range(config['warmup']):
+        step()
+    warmup = perf_counter() - a
+
+    latencies = np.empty(config['steps'])
+    for i in range(config['steps']):
+        a = perf_counter()
+        step()
+        latencies[i] = perf_counter() - a
+
+    result = dict(config)
+    result.pop('weights', None)
+    result.update({
+        'warmup_sec': warmup,
+        'samples_per_sec': config['steps'] * config['batch_size'] * config['predict_dist'] / latencies.sum(),
+        'latency_ms': {'p50': np.percentile(latencies, 50) * 1000, 'p90': np.percentile(latencies, 90) * 1000,
+                       'p99': np.percentile(latencies, 99) * 1000},
+        'peak_rss_mb': peak_rss_mb(),
+    })
+    return result
+
+
+def configurations(args):
+    for radix, depth, channels, transpose, pred_dist, batch_size, threads, engine in itertools.product(
+            args.radixs, args.depths or [None], args.fft_channels, args.transpose, args.predict_dist,
+            args.batch_size, args.threads, args.engines):
+        if depth is None:
+            depth = max(1, round(math.log(args.receptive_field) / math.log(radix)))
+        yield {'engine': engine, 'radix': radix, 'depth': depth, 'receptive_field': radix ** depth,
+               'fft_channels': channels, 'transpose': transpose, 'predict_dist': pred_dist,
+               'batch_size': batch_size, 'threads': threads, 'aux_channels': args.aux_channels,
+               'classes': args.classes, 'warmup': args.warmup, 'steps': args.steps}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    ctx = get_context('spawn')
+    results = []
+    for config in configurations(args):
+        # every configuration runs in a fresh process, so peak RSS and thread settings do not leak between runs,
+        # the BLAS thread variables have to be set before the process imports numpy
+        for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            os.environ[name] = str(config['threads'])
+        with tempfile.TemporaryDirectory() as tmp:
+            if config['engine'] == 'numpy':
+                config['weights'] = os.path.join(tmp, 'weights.npz')
+                with ctx.Pool(1) as pool:
+                    pool.apply(export_numpy_weights, (config, config['weights']))
+            with ctx.Pool(1) as pool:
+                result = pool.apply(run_config, (config,))
+        results.append(result)
+        print("{engine:>11} radix {radix} depth {depth:>2} channels {fft_channels} transpose {transpose} "
+              "predict_dist {predict_dist} batch {batch_size} threads {threads}: {samples_per_sec:.1f} samples/sec, "
+              "p50 {p50:.3f} ms, p99 {p99:.3f} ms, peak RSS {peak_rss_mb:.1f} MB".format(
+                  p50=result['latency_ms']['p50'], p99=result['latency_ms']['p99'], **result))
+
+    if args.outfile is not None:
+        with open(args.outfile, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results saved to", args.outfile)
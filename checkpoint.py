@@ -0,0 +1,124 @@
+import os
+import re
+import random
+import threading
+import numpy as np
+import torch
+
+from models import general_FFTNet
+
+
+def _to_cpu(obj):
+    # a copy of obj with every tensor copied to the cpu, so training can go on while it is written
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer:
+    """Save training checkpoints to directory as prefix_<step>.ckpt, keeping the last keep of them.
+
+    A checkpoint holds the model config and state_dict, the optimizer (and grad scaler) state, the step, the RNG
+    states and any extra values. save copies the state to the cpu, then writes it on a background thread to a
+    temporary file that is renamed when complete, so the training loop only waits for the copy and a crash never
+    leaves a partial checkpoint.
+    """
+
+    def __init__(self, directory, prefix, keep=5):
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        self.thread = None
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, step):
+        return os.path.join(self.directory, '{}_{}.ckpt'.format(self.prefix, step))
+
+    def steps(self):
+        """Steps of the checkpoints in the directory, oldest first."""
+        pattern = re.compile(re.escape(self.prefix) + r'_(\d+)\.ckpt$')
+        matches = (pattern.match(f) for f in os.listdir(self.directory))
+        return sorted(int(m.group(1)) for m in matches if m)
+
+    def latest(self):
+        """Path of the newest checkpoint, None if there is none."""
+        steps = self.steps()
+        return self.path(steps[-1]) if steps else None
+
+    def save(self, step, model, optimizer, scaler=None, **extra):
+        self.wait()
+        state = _to_cpu({'config': model.get_config(), 'model': model.state_dict(),
+                         'optimizer': optimizer.state_dict(),
+                         'scaler': scaler.state_dict() if scaler is not None else None,
+                         'step': step, 'rng': rng_state(), 'extra': extra})
+        self.thread = threading.Thread(target=self._write, args=(step, state))
+        self.thread.start()
+
+    def _write(self, step, state):
+        try:
+            path = self.path(step)
+            tmp = path + '.tmp'
+            torch.save(state, tmp)
+            os.replace(tmp, path)
+            for old in self.steps()[:-self.keep]:
+                os.remove(self.path(old))
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """Block until the last checkpoint is written, raising the error of the write if it failed."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def load_checkpoint(path, model=None, optimizer=None, scaler=None, map_location='cpu'):
+    """Load a checkpoint written by Checkpointer into the given objects and restore the RNG states.
+
+    Returns the checkpoint dict, its 'config' can build the model with general_FFTNet(**config).
+    """
+    state = torch.load(path, map_location=map_location, weights_only=False)
+    if model is not None:
+        model.load_state_dict(state['model'])
+    if optimizer is not None:
+        optimizer.load_state_dict(state['optimizer'])
+    if scaler is not None and state['scaler'] is not None:
+        scaler.load_state_dict(state['scaler'])
+    set_rng_state(state['rng'])
+    return state
+
+
+def load_network(filename, map_location='cpu'):
+    """The model in filename, either a whole module saved by train.py or a checkpoint written by Checkpointer.
+
+    Unlike load_checkpoint, the RNG states are left as they are.
+    """
+    state = torch.load(filename, map_location=map_location, weights_only=False)
+    if not isinstance(state, dict):
+        return state
+    net = general_FFTNet(**state['config'])
+    net.load_state_dict(state['model'])
+    return net
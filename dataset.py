@@ -1,9 +1,247 @@
 from torch.utils.data import Dataset
 import torch
 import os
+import json
 import numpy as np
 from sklearn.preprocessing import StandardScaler
-from scipy.interpolate import interp1d
+from utils import Running_Stats
+
+
+def packed_paths(folder, split):
+    return {'audio': os.path.join(folder, split + '_audio.bin'),
+            'features': os.path.join(folder, split + '_features.bin'),
+            'index': os.path.join(folder, split + '_index.npz'),
+            'manifest': os.path.join(folder, split + '_manifest.jsonl')}
+
+
+class Packed_Writer:
+    """Append utterances to the packed format of a split: every mu-law encoded sample in one flat uint8 file, every
+    feature frame in one flat (frames, feature_dim) file, and an index with the names and offsets, written on close.
+
+    Only the offsets stay in memory, so the size of the corpus is not limited by RAM. The feature statistics of the
+    split are accumulated in stats (see utils.Running_Stats) and saved in the index.
+    Every sync_every utterances the data files are flushed to disk, then the new utterances and the statistics so
+    far are appended to a manifest, so the manifest only lists utterances that are fully written. With resume=True a
+    writer continues from the manifest of an interrupted run (one that never wrote its index), if it was written
+    with the same meta, and drops anything written after its last entry; names lists the utterances already there.
+    """
+
+    def __init__(self, folder, split, feature_dtype=np.float32, *, resume=False, meta=None, sync_every=64):
+        os.makedirs(folder, exist_ok=True)
+        self.paths = packed_paths(folder, split)
+        self.feature_dtype = np.dtype(feature_dtype)
+        self.meta = dict(meta or {}, feature_dtype=self.feature_dtype.str)
+        self.sync_every = sync_every
+        self.names, self.audio_offsets, self.feature_offsets = [], [0], [0]
+        self.feature_dim = None
+        self.stats = Running_Stats()
+        self.unsynced = []
+        # a finished split has an index, it is written again from the start and the index rewritten on close
+        finished = os.path.exists(self.paths['index'])
+        if finished:
+            os.remove(self.paths['index'])
+
+        if resume and not finished and self._load_manifest():
+            self.audio_file = open(self.paths['audio'], 'r+b')
+            self.feature_file = open(self.paths['features'], 'r+b')
+            for f, size in ((self.audio_file, self.audio_offsets[-1]),
+                            (self.feature_file, self.feature_offsets[-1] * self.feature_bytes)):
+                f.truncate(size)
+                f.seek(size)
+            self.manifest = open(self.paths['manifest'], 'a')
+        else:
+            self.names, self.audio_offsets, self.feature_offsets = [], [0], [0]
+            self.feature_dim = None
+            self.stats = Running_Stats()
+            self.audio_file = open(self.paths['audio'], 'wb')
+            self.feature_file = open(self.paths['features'], 'wb')
+            self.manifest = open(self.paths['manifest'], 'w')
+            self.manifest.write(json.dumps(self.meta) + '\n')
+            self.manifest.flush()
+
+    @property
+    def feature_bytes(self):
+        # bytes of one feature frame
+        return (self.feature_dim or 0) * self.feature_dtype.itemsize
+
+    def _load_manifest(self):
+        # restore the utterances of the manifest, returns False if there is nothing to resume
+        if not all(os.path.exists(self.paths[name]) for name in ('audio', 'features', 'manifest')):
+            return False
+        with open(self.paths['manifest'], 'rb') as f:
+            lines = f.read().split(b'\n')
+        try:
+            if json.loads(lines[0]) != json.loads(json.dumps(self.meta)):
+                return False
+        except ValueError:
+            return False
+        # entries count once the statistics line written after them is there, the last line may be cut
+        position = good = len(lines[0]) + 1
+        n_good = 0
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            position += len(line) + 1
+            if isinstance(entry, dict):
+                self.stats = Running_Stats.from_state_dict(entry['stats'])
+                good, n_good = position, len(self.names)
+                continue
+            name, length, frames, feature_dim = entry
+            self.names.append(name)
+            self.audio_offsets.append(self.audio_offsets[-1] + length)
+            self.feature_offsets.append(self.feature_offsets[-1] + frames)
+            self.feature_dim = feature_dim
+        del self.names[n_good:], self.audio_offsets[n_good + 1:], self.feature_offsets[n_good + 1:]
+        if (os.path.getsize(self.paths['audio']) < self.audio_offsets[-1] or
+                os.path.getsize(self.paths['features']) < self.feature_offsets[-1] * self.feature_bytes):
+            return False
+        with open(self.paths['manifest'], 'r+b') as f:
+            f.truncate(good)
+        return True
+
+    def add(self, name, audio, features, stats=None):
+        """audio: encoded samples of shape (T,), features: (feature_dim, frames), stats: their Running_Stats if they
+        are already known."""
+        if self.feature_dim is None:
+            self.feature_dim = features.shape[0]
+        elif features.shape[0] != self.feature_dim:
+            raise ValueError("{} has {} feature dimensions, expected {}.".format(name, features.shape[0],
+                                                                                self.feature_dim))
+        self.audio_file.write(np.ascontiguousarray(audio, dtype=np.uint8).tobytes())
+        self.feature_file.write(np.ascontiguousarray(features.T, dtype=self.feature_dtype).tobytes())
+        self.names.append(name)
+        self.audio_offsets.append(self.audio_offsets[-1] + len(audio))
+        self.feature_offsets.append(self.feature_offsets[-1] + features.shape[1])
+        self.stats.merge(stats if stats is not None else Running_Stats.from_array(features.T))
+        self.unsynced.append(json.dumps([name, len(audio), features.shape[1], self.feature_dim]))
+        if len(self.unsynced) >= self.sync_every:
+            self._sync()
+
+    def _sync(self):
+        # the data goes to disk before the manifest entries that point to it
+        for f in (self.audio_file, self.feature_file):
+            f.flush()
+            os.fsync(f.fileno())
+        if not self.unsynced:
+            return
+        for line in self.unsynced:
+            self.manifest.write(line + '\n')
+        self.manifest.write(json.dumps({'stats': self.stats.state_dict()}) + '\n')
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+        self.unsynced = []
+
+    def close(self, complete=True):
+        """Sync and close the files, and write the index unless complete is False."""
+        self._sync()
+        self.audio_file.close()
+        self.feature_file.close()
+        self.manifest.close()
+        if complete:
+            np.savez(self.paths['index'], names=np.array(self.names), audio_offsets=np.array(self.audio_offsets),
+                     feature_offsets=np.array(self.feature_offsets), feature_dim=self.feature_dim or 0,
+                     feature_dtype=self.feature_dtype.str, stats_count=self.stats.count,
+                     stats_mean=self.stats.mean if self.stats.count else [],
+                     stats_m2=self.stats.m2 if self.stats.count else [])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # an interrupted split keeps its manifest for resuming but gets no index
+        self.close(complete=exc_type is None)
+
+
+def pack_npz(npzfile, folder, split, feature_dtype=np.float32):
+    """Convert a train.npz or test.npz written by older versions of preprocess.py to the packed format."""
+    data_dict = np.load(npzfile)
+    with Packed_Writer(folder, split, feature_dtype) as writer:
+        for name in data_dict.keys():
+            if name[-2:] != '_h':
+                writer.add(name, data_dict[name], data_dict[name + '_h'])
+
+
+class Packed_Corpus:
+    """Read access to a split written by Packed_Writer, the data files are memory mapped so nothing is loaded up
+    front, and each process maps them on first access instead of receiving a pickled copy."""
+
+    def __init__(self, folder, split):
+        self.paths = packed_paths(folder, split)
+        index = np.load(self.paths['index'])
+        self.names = [str(name) for name in index['names']]
+        self.audio_offsets = index['audio_offsets']
+        self.feature_offsets = index['feature_offsets']
+        self.feature_dim = int(index['feature_dim'])
+        self.feature_dtype = np.dtype(str(index['feature_dtype']))
+        # feature statistics, missing from splits written before they were recorded
+        self.stats = (Running_Stats(index['stats_count'], index['stats_mean'], index['stats_m2'])
+                      if 'stats_count' in index and index['stats_count'] else None)
+        self._audio = self._features = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_audio'] = state['_features'] = None
+        return state
+
+    def _map(self):
+        if self.audio_offsets[-1]:
+            self._audio = np.memmap(self.paths['audio'], dtype=np.uint8, mode='r')
+            self._features = np.memmap(self.paths['features'], dtype=self.feature_dtype, mode='r',
+                                       shape=(int(self.feature_offsets[-1]), self.feature_dim))
+        else:
+            self._audio = np.empty(0, dtype=np.uint8)
+            self._features = np.empty((0, self.feature_dim), dtype=self.feature_dtype)
+
+    @property
+    def all_audio(self):
+        if self._audio is None:
+            self._map()
+        return self._audio
+
+    @property
+    def all_features(self):
+        """Every feature frame of the split, of shape (frames, feature_dim)."""
+        if self._features is None:
+            self._map()
+        return self._features
+
+    def audio(self, index):
+        return self.all_audio[self.audio_offsets[index]:self.audio_offsets[index + 1]]
+
+    def features(self, index):
+        """Features of utterance index, of shape (feature_dim, frames), a view of the mapped file."""
+        return self.all_features[self.feature_offsets[index]:self.feature_offsets[index + 1]].T
+
+
+def upsample_window(h, start, length, hopsize, interp_method, transform_fn=None):
+    """Columns [start, start + length) of the features h (feature_dim, frames) upsampled to the sample rate.
+
+    Only the frames around the window are read and passed through transform_fn. The result is the same as
+    upsampling the whole utterance with interp1d on frames placed every hopsize samples ('linear'), or with
+    np.repeat ('repeat'), then slicing the window.
+    """
+    n = np.arange(start, start + length)
+    if interp_method == 'repeat':
+        idx = n // hopsize
+        frames = h[:, idx[0]:idx[-1] + 1].T
+        frames = transform_fn(frames) if transform_fn is not None else np.asarray(frames)
+        return frames[idx - idx[0]].T
+
+    # the same steps as interp1d: the upper frame of column n is the first one placed at or after n
+    hi = np.clip(-(-n // hopsize), 1, h.shape[1] - 1)
+    first = hi[0] - 1
+    frames = h[:, first:hi[-1] + 1].T
+    frames = np.ascontiguousarray(transform_fn(frames) if transform_fn is not None else frames)
+    # slopes are computed once per pair of frames, then gathered for every column
+    slopes = (frames[1:] - frames[:-1]) / np.full((1, 1), hopsize)
+    lo = hi - 1 - first
+    return (slopes[lo] * (n - (hi - 1) * hopsize)[:, None] + frames[lo]).T
+
 
 class CMU_Dataset(Dataset):
     def __init__(self,
@@ -23,61 +261,136 @@ class CMU_Dataset(Dataset):
         self.interp_method = interp_method
         self.injected_noise = injected_noise
         self.predict_dist = predict_dist
-        if train:
-            npzfile = os.path.join(folder, "train.npz")
-        else:
-            npzfile = os.path.join(folder, "test.npz")
+        split = 'train' if train else 'test'
+        if not os.path.exists(packed_paths(folder, split)['index']):
+            print("Packing", split + ".npz", "...")
+            pack_npz(os.path.join(folder, split + ".npz"), folder, split)
+        self.corpus = Packed_Corpus(folder, split)
+        self.names_list = self.corpus.names
         scaler = StandardScaler()
         scaler_info = np.load(os.path.join(folder, 'scaler.npz'))
         scaler.mean_ = scaler_info['mean']
         scaler.scale_ = scaler_info['scale']
         self.transform_fn = scaler.transform
 
-        self.names_list = []
-        data_dict = np.load(npzfile)
-        self.data_buffer = {}
-        for name, x in data_dict.items():
-            if name[-2:] != '_h':
-                self.names_list.append(name)
-                self.data_buffer[name] = x
-            else:
-                self.data_buffer[name] = self.transform_fn(x.T).T
-
     def __len__(self):
         return len(self.names_list)
 
     def __getitem__(self, index):
         name = self.names_list[index]
-        audio = self.data_buffer[name].astype(int)
-        local_condition = self.data_buffer[name + '_h']
+        audio = self.corpus.audio(index)
 
         if self.train:
             rand_pos = np.random.randint(0, len(audio) - self.sample_size - self.predict_dist)
-            target = audio[rand_pos + self.predict_dist:rand_pos + self.predict_dist + self.sample_size]
-            audio = audio[rand_pos:rand_pos + self.sample_size]
+            # input and target are views of one copy of the window, the noise is added to a new input array
+            audio = audio[rand_pos:rand_pos + self.predict_dist + self.sample_size].astype(int)
+            target = audio[self.predict_dist:]
+            audio = audio[:self.sample_size]
 
             if self.injected_noise:
-                audio += np.rint(np.random.randn(self.sample_size) * 0.5).astype(int)
+                audio = audio + np.rint(np.random.randn(self.sample_size) * 0.5).astype(int)
                 audio = np.clip(audio, 0, self.channels - 1)
 
             # interpolation
-            if self.interp_method == 'linear':
-                x = np.arange(local_condition.shape[1]) * self.hopsize
-                f = interp1d(x, local_condition, copy=False, axis=1)
-                local_condition = f(
-                    np.arange(rand_pos + self.predict_dist, rand_pos + self.predict_dist + self.sample_size))
-            elif self.interp_method == 'repeat':
-                local_condition = np.repeat(local_condition, self.hopsize, axis=1)
-                local_condition = local_condition[:,
-                                  rand_pos + self.predict_dist:rand_pos + self.predict_dist + self.sample_size]
-            else:
+            if self.interp_method not in ('linear', 'repeat'):
                 print("interpolation method", self.interp_method, "is not implemented.")
                 exit(1)
+            local_condition = upsample_window(self.corpus.features(index), rand_pos + self.predict_dist,
+                                              self.sample_size, self.hopsize, self.interp_method, self.transform_fn)
 
             return torch.from_numpy(audio).long(), torch.from_numpy(target).long(), torch.from_numpy(
                 local_condition).float()
         else:
+            audio = audio.astype(int)
+            local_condition = self.transform_fn(self.corpus.features(index).T).T
             name_code = [ord(c) for c in name]
             # the batch size should be 1 in test mode
             return torch.LongTensor(name_code), torch.from_numpy(audio).long(), torch.from_numpy(
-                local_condition).float()
\ No newline at end of file
+                local_condition).float()
+
+
+class CMU_Window_Batches(CMU_Dataset):
+    """Training batches of random windows drawn from the whole corpus at once.
+
+    Item i is a full batch: batch_size (utterance, position) pairs are drawn together, then the inputs, targets and
+    conditioning of every window are read with one gather each from the packed corpus. Use it with
+    DataLoader(batch_size=None). Items are the same as stacking batch_size CMU_Dataset items.
+    steps_per_epoch: number of batches of an epoch, independent of the number of utterances.
+    weighted: draw utterances proportionally to their number of windows, so every window of the corpus is equally
+    likely, otherwise every utterance is equally likely like CMU_Dataset.
+    rank, world_size: in distributed training, each rank only draws from its own shard of the utterances, every
+    world_size-th one starting at rank.
+    seed: item i is drawn from a generator seeded with (seed, rank, i), so it does not depend on which worker
+    draws it or on the items drawn before, and training resumed at step i reads the same batches. Without it, random
+    numbers come from torch, which DataLoader seeds differently in each worker.
+    """
+
+    def __init__(self, folder, batch_size, sample_size, quantization_channels, hopsize, interp_method, *,
+                 predict_dist=1, injected_noise=True, steps_per_epoch=1000, weighted=False, rank=0, world_size=1,
+                 seed=None):
+        super().__init__(folder, sample_size, quantization_channels, hopsize, interp_method,
+                         predict_dist=predict_dist, injected_noise=injected_noise)
+        if interp_method not in ('linear', 'repeat'):
+            raise ValueError("interpolation method " + interp_method + " is not implemented.")
+        self.batch_size = batch_size
+        self.steps_per_epoch = steps_per_epoch
+        self.rank = rank
+        self.seed = seed
+        lengths = np.diff(self.corpus.audio_offsets)
+        # number of start positions of each utterance
+        self.positions = torch.from_numpy(np.maximum(lengths - sample_size - predict_dist, 0))
+        self.positions[np.arange(len(lengths)) % world_size != rank] = 0
+        if not self.positions.sum():
+            raise ValueError("No utterance of shard {} is longer than {} samples.".format(rank,
+                                                                                     sample_size + predict_dist))
+        self.weights = (self.positions if weighted else (self.positions > 0)).double()
+        self.window = np.arange(sample_size + predict_dist)
+        self.columns = np.arange(predict_dist, predict_dist + sample_size)
+        # frames read per window, enough for both interpolation methods
+        self.frames = sample_size // hopsize + 3
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __getitem__(self, index):
+        generator = None
+        if self.seed is not None:
+            generator = torch.Generator().manual_seed(
+                int(np.random.SeedSequence([self.seed, self.rank, index]).generate_state(1, np.uint64)[0] >> 1))
+        utterances = torch.multinomial(self.weights, self.batch_size, replacement=True, generator=generator)
+        rand_pos = (torch.rand(self.batch_size, dtype=torch.double, generator=generator)
+                    * self.positions[utterances].double()).long()
+        utterances, rand_pos = utterances.numpy(), rand_pos.numpy()
+
+        # input and target are views of one copy of the windows, the noise is added to a new input array
+        audio = self.corpus.all_audio[(self.corpus.audio_offsets[utterances] + rand_pos)[:, None] + self.window]
+        audio = audio.astype(int)
+        target = audio[:, self.predict_dist:]
+        audio = audio[:, :self.sample_size]
+        if self.injected_noise:
+            noise = torch.randn(audio.shape, dtype=torch.double, generator=generator).mul_(0.5).round_().long()
+            audio = audio + noise.numpy()
+            audio = np.clip(audio, 0, self.channels - 1)
+
+        # the frames each column reads, as in upsample_window
+        n = rand_pos[:, None] + self.columns
+        last_frame = np.diff(self.corpus.feature_offsets)[utterances, None] - 1
+        if self.interp_method == 'repeat':
+            lo = n // self.hopsize
+        else:
+            hi = np.clip(-(-n // self.hopsize), 1, last_frame)
+            lo = hi - 1
+        first = lo[:, :1]
+        rows = np.minimum(first + np.arange(self.frames), last_frame) + self.corpus.feature_offsets[utterances, None]
+        frames = self.transform_fn(self.corpus.all_features[rows.reshape(-1)])
+        frames = frames.reshape(self.batch_size, self.frames, -1)
+        batch = np.arange(self.batch_size)[:, None]
+        lo = lo - first
+        if self.interp_method == 'repeat':
+            local_condition = frames[batch, lo]
+        else:
+            slopes = (frames[:, 1:] - frames[:, :-1]) / np.full((1, 1, 1), self.hopsize)
+            local_condition = slopes[batch, lo] * (n - (hi - 1) * self.hopsize)[..., None] + frames[batch, lo]
+
+        return torch.from_numpy(audio).long(), torch.from_numpy(target).long(), torch.from_numpy(
+            local_condition.transpose(0, 2, 1)).float()
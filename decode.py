@@ -1,15 +1,18 @@
 import torch
-from torch.nn import functional as F
-from tqdm import tqdm
 import os
 import argparse
 import numpy as np
+import wave
+from datetime import datetime
+from multiprocessing import cpu_count, get_context
+from concurrent.futures import ProcessPoolExecutor
 from torchaudio import save
 from sklearn.preprocessing import StandardScaler
 from scipy.interpolate import interp1d
-from datetime import datetime
 from utils import decoder, logmmse, vad
 from preprocess import get_features
+from streaming import stream_generate
+from checkpoint import load_network
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--infile', type=str, default=None)
@@ -25,6 +28,12 @@ parser.add_argument('--window_length', type=float, default=0.025)
 parser.add_argument('--window_step', type=float, default=0.01)
 parser.add_argument('--minimum_f0', type=float, default=71)
 parser.add_argument('--maximum_f0', type=float, default=800)
+parser.add_argument('--f0_method', type=str, default='harvest', help='harvest or dio, dio is much faster but use '
+                                                                     'the method the model was trained with.')
+parser.add_argument('--chunk_length', type=float, default=None, help='extract the features of files longer than '
+                                                                     'this many seconds in parallel chunks.')
+parser.add_argument('--feature_workers', type=int, default=cpu_count(), help='number of processes extracting the '
+                                                                             'chunks of one file.')
 parser.add_argument('--q_channels', type=int, default=256, help='quantization channels')
 parser.add_argument('--interp_method', type=str, default='linear')
 parser.add_argument('-c', type=float, default=2., help='a constant multiply before softmax.')
@@ -32,12 +41,22 @@ parser.add_argument('--model_file', type=str, default='slt_fftnet.pth')
 parser.add_argument('--cuda', action='store_true')
 parser.add_argument('--denoise', action='store_true')
 parser.add_argument('--noise_std', type=float, default=0.005)
+parser.add_argument('--stream', action='store_true', help='feed the features frame by frame and write audio chunks '
+                                                           'as soon as they are generated.')
+parser.add_argument('--chunk_size', type=int, default=1600, help='number of samples per chunk in stream mode.')
+parser.add_argument('--indir', type=str, default=None, help='decode every wav file in this directory.')
+parser.add_argument('--filelist', type=str, default=None, help='decode the wav files listed in this file, '
+                                                                'one per line.')
+parser.add_argument('--outdir', type=str, default=None, help='output directory of --indir and --filelist.')
+parser.add_argument('--workers', type=int, default=None, help='number of decoding processes, default cpu count / '
+                                                              'threads.')
+parser.add_argument('--threads', type=int, default=1, help='number of intra-op threads of each decoding process.')
 
 sampling_rate = 16000
 
-if __name__ == '__main__':
-    args = parser.parse_args()
-    net = torch.load(args.model_file)
+
+def load_model(args):
+    net = load_network(args.model_file)
     scaler = StandardScaler()
     scaler_info = np.load(os.path.join(args.data_dir, 'scaler.npz'))
     scaler.mean_ = scaler_info['mean']
@@ -48,21 +67,49 @@ if __name__ == '__main__':
         net = net.cpu()
     else:
         net = net.cuda()
+    return net, scaler
+
 
-    print(args.model_file, "has", sum(p.numel() for p in net.parameters() if p.requires_grad), "of parameters.")
+def decode_file(net, scaler, infile, outfile, args, verbose=True, executor=None):
+    """Reconstruct infile from its features into outfile, returns the number of samples written.
 
+    With an executor, the features of files longer than args.chunk_length are extracted in parallel chunks.
+    """
     with torch.no_grad():
-        if args.infile is None:
-            # haven't implement
-            pass
-        elif args.outfile is not None:
-            id, x, h = get_features(args.infile, winlen=args.window_length, winstep=args.window_step,
-                                    n_mcep=args.feature_dim, mcep_alpha=args.mcep_alpha, minf0=args.minimum_f0,
-                                    maxf0=args.maximum_f0, type=args.feature_type)
-
-            h = scaler.transform(h.T).T
+        a = datetime.now()
+        id, x, h = get_features(infile, winlen=args.window_length, winstep=args.window_step,
+                                n_mcep=args.feature_dim, mcep_alpha=args.mcep_alpha, minf0=args.minimum_f0,
+                                maxf0=args.maximum_f0, type=args.feature_type, f0_method=args.f0_method,
+                                chunk_length=args.chunk_length if executor is not None else None,
+                                executor=executor)
+        if verbose:
+            print("Features extracted in", (datetime.now() - a).total_seconds(), "seconds.")
+
+        h = scaler.transform(h.T).T
+        hopsize = int(sampling_rate * args.window_step)
+        if args.stream:
+            if args.denoise:
+                print("Denoising needs the whole utterance, ignored in stream mode.")
+            voiced = vad(torch.from_numpy(x), hopsize).numpy() > 0.5
+            voiced = np.pad(voiced, (0, max(0, h.shape[1] - len(voiced))), 'constant')
+            if verbose:
+                print("Streaming file", infile)
+            a = datetime.now()
+            length = 0
+            with wave.open(outfile, 'wb') as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(sampling_rate)
+                for chunk in stream_generate(net, h.T, hopsize, interp_method=args.interp_method,
+                                             c=np.where(voiced, args.c, 1.), chunk_size=args.chunk_size):
+                    if not length and verbose:
+                        print("First chunk after", (datetime.now() - a).total_seconds(), "seconds.")
+                    f.writeframes(np.int16(np.clip(chunk.cpu().numpy(), -1., 1.) * 32767).tobytes())
+                    length += chunk.size(0)
+            if verbose:
+                print("Speed:", length / (datetime.now() - a).total_seconds(), "samples/sec.")
+        else:
             # interpolation
-            hopsize = int(sampling_rate * args.window_step)
             if args.interp_method == 'linear':
                 xx = np.arange(h.shape[1]) * hopsize
                 f = interp1d(xx, h, copy=False, axis=1)
@@ -74,37 +121,86 @@ if __name__ == '__main__':
                 exit(1)
 
             h = torch.from_numpy(h).unsqueeze(0).float()
-            r_field = net.get_receptive_field()
             pred_dist = net.get_predict_distance()
 
-            vad_curve = vad(torch.from_numpy(x), hopsize).numpy()
-            vad_curve = np.repeat(vad_curve, hopsize)
-
-            output_buf = torch.empty(h.size(2)).long()
-            h = F.pad(h, (r_field, 0))
-            samples = torch.zeros(pred_dist).long()
-            if args.cuda:
-                h = h.cuda()
-                samples = samples.cuda()
-
-            net.init_buf()
-            print("Decoding file", args.infile)
-            a = datetime.now().replace(microsecond=0)
-            for pos in tqdm(range(r_field + pred_dist, h.size(2) + 1, pred_dist)):
-                out_pos = pos - r_field - pred_dist
-                decision = np.mean(vad_curve[out_pos:out_pos + pred_dist])
-                if decision > 0.5:
-                    samples = net.one_sample_generate(samples, h=h[:, :, :pos], c=args.c)
-                else:
-                    samples = net.one_sample_generate(samples, h=h[:, :, :pos])
-
-                output_buf[out_pos:out_pos + pred_dist] = samples
-            cost = datetime.now().replace(microsecond=0) - a
+            # voiced steps are sampled with the constant c, unvoiced ones from the plain softmax
+            steps = -(-h.size(2) // pred_dist)
+            vad_curve = np.repeat(vad(torch.from_numpy(x), hopsize).numpy(), hopsize)[:steps * pred_dist]
+            vad_curve = np.pad(vad_curve, (0, steps * pred_dist - len(vad_curve)), 'constant')
+            decision = vad_curve.reshape(steps, pred_dist).mean(1) > 0.5
+            c = torch.from_numpy(np.repeat(np.where(decision, args.c, 1.), pred_dist)).float()
+
+            if verbose:
+                print("Decoding file", infile)
+            output_buf = net.fast_generate(h=h, c=c, verbose=verbose).cpu()
             dec = decoder(args.q_channels)
             generation = dec(output_buf)
             if args.denoise:
                 generation = logmmse(generation, sampling_rate, noise_std=args.noise_std)
-            save(args.outfile, generation.view(-1, 1), sampling_rate)
-            print("Speed:", generation.size(0) / cost.total_seconds(), "samples/sec.")
+            save(outfile, generation.view(-1, 1), sampling_rate)
+            length = output_buf.size(0)
+    return length
+
+
+# model and arguments of a batch mode worker process, loaded once per process
+_worker = {}
+
+
+def _init_worker(args):
+    torch.set_num_threads(args.threads)
+    _worker['net'], _worker['scaler'] = load_model(args)
+    _worker['args'] = args
+
+
+def _decode_job(files):
+    infile, outfile = files
+    a = datetime.now()
+    length = decode_file(_worker['net'], _worker['scaler'], infile, outfile, _worker['args'], verbose=False)
+    return infile, length, (datetime.now() - a).total_seconds()
+
+
+def decode_batch(files, args):
+    """Decode files over a pool of worker processes, each output is written as soon as it is finished."""
+    os.makedirs(args.outdir, exist_ok=True)
+    workers = args.workers or max(1, cpu_count() // args.threads)
+    jobs = [(f, os.path.join(args.outdir, os.path.basename(f))) for f in files]
+    print("Decoding", len(jobs), "files with", workers, "processes of", args.threads, "threads.")
+
+    a = datetime.now()
+    total_length, rtfs = 0, []
+    with get_context('spawn').Pool(workers, initializer=_init_worker, initargs=(args,)) as pool:
+        for infile, length, cost in pool.imap_unordered(_decode_job, jobs):
+            total_length += length
+            rtfs.append(cost * sampling_rate / length)
+            print(infile, "{} samples, real-time factor {:.3f}.".format(length, rtfs[-1]))
+    cost = (datetime.now() - a).total_seconds()
+    print("Total:", len(jobs), "files,", total_length / cost, "samples/sec.")
+    print("Real-time factor per file: mean {:.3f}, min {:.3f}, max {:.3f}.".format(np.mean(rtfs), np.min(rtfs),
+                                                                                 np.max(rtfs)))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.indir is not None or args.filelist is not None:
+        if args.outdir is None:
+            print("Please enter output directory.")
+            exit(1)
+        if args.indir is not None:
+            files = sorted(os.path.join(args.indir, f) for f in os.listdir(args.indir) if f.endswith('.wav'))
+        else:
+            with open(args.filelist) as f:
+                files = [line.strip() for line in f if line.strip()]
+        decode_batch(files, args)
+    elif args.infile is None:
+        # haven't implement
+        pass
+    elif args.outfile is not None:
+        net, scaler = load_model(args)
+        print(args.model_file, "has", sum(p.numel() for p in net.parameters() if p.requires_grad), "of parameters.")
+        if args.chunk_length is not None and args.feature_workers > 1:
+            with ProcessPoolExecutor(args.feature_workers) as executor:
+                decode_file(net, scaler, args.infile, args.outfile, args, executor=executor)
         else:
-            print("Please enter output file name.")
+            decode_file(net, scaler, args.infile, args.outfile, args)
+    else:
+        print("Please enter output file name.")
@@ -0,0 +1,75 @@
+import os
+import argparse
+import numpy as np
+from time import perf_counter
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from librosa.core import load
+
+from preprocess import world_features, chunked_features
+
+parser = argparse.ArgumentParser(description='Speed and F0 error of the feature extraction modes against harvest.')
+parser.add_argument('--wav_dir', type=str, default='samples')
+parser.add_argument('--max_files', type=int, default=20)
+parser.add_argument('--feature_type', type=str, default='mcc')
+parser.add_argument('--feature_dim', type=int, default=25, help='number of mcc coefficients')
+parser.add_argument('--mcep_alpha', type=float, default=0.42)
+parser.add_argument('--window_length', type=float, default=0.025)
+parser.add_argument('--window_step', type=float, default=0.01)
+parser.add_argument('--minimum_f0', type=float, default=71)
+parser.add_argument('--maximum_f0', type=float, default=800)
+parser.add_argument('--chunk_length', type=float, default=1., help='chunk length in seconds of the chunked modes.')
+parser.add_argument('--workers', type=int, default=cpu_count(), help='number of processes of the chunked modes.')
+
+
+def f0_errors(f0, reference):
+    """Voicing decision error, gross pitch error (over 20% off) and mean absolute error in cents, the last two on
+    frames voiced in both."""
+    voiced, ref_voiced = f0 > 0, reference > 0
+    both = voiced & ref_voiced
+    ratio = f0[both] / reference[both]
+    return {'vde': np.mean(voiced != ref_voiced),
+            'gpe': np.mean(np.abs(ratio - 1) > 0.2) if both.any() else 0.,
+            'cents': np.mean(np.abs(1200 * np.log2(ratio))) if both.any() else 0.}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    params = dict(winlen=args.window_length, winstep=args.window_step, n_mcep=args.feature_dim,
+                  mcep_alpha=args.mcep_alpha, minf0=args.minimum_f0, maxf0=args.maximum_f0, type=args.feature_type)
+    files = sorted(os.path.join(args.wav_dir, f) for f in os.listdir(args.wav_dir) if f.endswith('.wav'))
+    files = files[:args.max_files]
+
+    modes = ['harvest', 'dio', 'harvest chunked', 'dio chunked']
+    costs = {mode: 0. for mode in modes}
+    errors = {mode: [] for mode in modes}
+    duration = 0.
+    with ProcessPoolExecutor(args.workers) as executor:
+        # start the processes before timing
+        list(executor.map(abs, range(args.workers)))
+        for f in files:
+            x, sr = load(f, sr=None)
+            x = x.astype(float)
+            duration += len(x) / sr
+            reference = None
+            for mode in modes:
+                method = mode.split()[0]
+                a = perf_counter()
+                if mode.endswith('chunked'):
+                    h = chunked_features(x, sr, chunk_length=args.chunk_length, executor=executor, f0_method=method,
+                                         **params)
+                else:
+                    h = world_features(x, sr, f0_method=method, **params)
+                costs[mode] += perf_counter() - a
+                if reference is None:
+                    reference = h[-1]
+                errors[mode].append(f0_errors(h[-1], reference))
+
+    print("{} files, {:.1f} seconds of audio, chunks of {} seconds over {} processes.".format(
+        len(files), duration, args.chunk_length, args.workers))
+    for mode in modes:
+        print("{:>16}: {:7.1f}x real time, {:5.2f}x harvest, voicing error {:5.2f}%, gross pitch error {:5.2f}%, "
+              "{:6.2f} cents".format(mode, duration / costs[mode], costs['harvest'] / costs[mode],
+                                      100 * np.mean([e['vde'] for e in errors[mode]]),
+                                      100 * np.mean([e['gpe'] for e in errors[mode]]),
+                                      np.mean([e['cents'] for e in errors[mode]])))
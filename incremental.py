@@ -0,0 +1,294 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from sampling import Sampler
+
+
+def _shared_linear(conv):
+    # a kernel_size=k Conv1d applied to k taps is a Linear over the flattened (channels, k) taps
+    weight = conv.weight.detach()
+    linear = nn.Linear(weight.size(1) * weight.size(2), weight.size(0))
+    linear.weight = nn.Parameter(weight.view(weight.size(0), -1), requires_grad=False)
+    linear.bias = nn.Parameter(conv.bias.detach(), requires_grad=False)
+    return linear
+
+
+def _class_embedding(conv):
+    # the first layer sees class indices; tap k of class c selects column (c, k) of the kernel
+    weight = conv.weight.detach()
+    embedding = nn.EmbeddingBag(weight.size(1) * weight.size(2), weight.size(0), mode='sum')
+    embedding.weight = nn.Parameter(weight.permute(2, 1, 0).reshape(-1, weight.size(0)), requires_grad=False)
+    return embedding
+
+
+class Incremental_FFTNet(nn.Module):
+    """Sample-by-sample inference engine for a trained general_FFTNet.
+
+    Each layer keeps its input history in a circular buffer with a moving write index. The buffer is stored twice
+    back to back, so the most recent history is always one contiguous slice and a step only writes the new columns
+    and reads the radix taps it needs, independent of the buffer length.
+    Conditioning is set once per utterance with condition(); the V_lr projections of all layers are then computed
+    ahead of the sample loop, cond_block samples at a time, so a step only indexes precomputed columns.
+    The first layer looks up the kernel columns of the input classes instead of multiplying one-hot vectors.
+    The engine shares parameters with the model it is built from, except the first layer's lookup table which is
+    copied, so rebuild it after updating the model.
+    """
+
+    def __init__(self, net, cond_block=2048):
+        super().__init__()
+        self.classes = net.classes
+        self.channels = net.channels
+        self.predict_dist = net.predict_dist
+        self.radixs = list(net.radixs)
+        self.dilations = [N // r for N, r in zip(net.N_seq, net.radixs)]
+        self.buf_lens = [(r - 1) * d + self.predict_dist for r, d in zip(self.radixs, self.dilations)]
+
+        self.W_lr = nn.ModuleList([_class_embedding(net.fft_layers[0].W_lr)])
+        self.W_lr_bias = nn.Parameter(net.fft_layers[0].W_lr.bias.detach(), requires_grad=False)
+        device = net.fc_out.weight.device
+        self.register_buffer('tap_offsets', torch.arange(self.radixs[0], device=device) * self.classes)
+        self.V_lr = nn.ModuleList()
+        self.W_o = nn.ModuleList()
+        for i, layer in enumerate(net.fft_layers):
+            if i:
+                self.W_lr.append(_shared_linear(layer.W_lr))
+            if layer.aux_channels is not None:
+                self.V_lr.append(_shared_linear(layer.V_lr))
+            self.W_o.append(_shared_linear(layer.W_o))
+        self.fc_out = nn.Linear(net.fc_out.in_features, net.fc_out.out_features)
+        self.fc_out.weight = nn.Parameter(net.fc_out.weight.detach(), requires_grad=False)
+        self.fc_out.bias = nn.Parameter(net.fc_out.bias.detach(), requires_grad=False)
+
+        if len(self.V_lr):
+            # every (layer, tap) conditioning kernel stacked into one matrix, so the projections of all layers are a
+            # single GEMM over the conditioning
+            self.V_stack = nn.Parameter(torch.cat([V.weight.view(V.out_features, -1, r).permute(2, 0, 1).reshape(
+                -1, V.weight.size(1) // r) for V, r in zip(self.V_lr, self.radixs)]), requires_grad=False)
+            self.cond_context = max((r - 1) * d for r, d in zip(self.radixs, self.dilations))
+        self.cond_block = cond_block
+
+        self.buffers = None
+        self.written = 0
+        self.condition()
+
+    def init_buf(self, batch_size=1, *, seed=None, greedy=None):
+        """Reset the state for a new batch of utterances, conditioning included.
+
+        seed and greedy set up the Sampler used to draw the samples, see sampling.Sampler.
+        """
+        device = self.W_lr_bias.device
+        self.sampler = Sampler(batch_size, self.predict_dist, self.classes, greedy=greedy, seed=seed, device=device)
+        self.buffers = [torch.full((batch_size, 2 * self.buf_lens[0]), self.classes // 2, dtype=torch.long,
+                                   device=device)]
+        self.buffers += [torch.zeros(batch_size, 2 * L, self.channels, device=device) for L in self.buf_lens[1:]]
+        self.written = 0
+        self.condition()
+
+    def _push(self, i, x):
+        # write x (B, predict_dist, ...) at the write index of layer i and return the last buf_lens[i] columns
+        buf, L = self.buffers[i], self.buf_lens[i]
+        start = self.written % L
+        end = start + x.size(1)
+        if end <= L:
+            buf[:, start:end] = x
+            buf[:, start + L:end + L] = x
+        else:
+            split = L - start
+            buf[:, start:L] = x[:, :split]
+            buf[:, start + L:] = x[:, :split]
+            buf[:, :end - L] = x[:, split:]
+            buf[:, L:end] = x[:, split:]
+        return buf[:, end % L:end % L + L]
+
+    def _taps(self, x, i):
+        # x: (B, L, C) window in time order -> (B * predict_dist, C * radix) dilated taps of every new column
+        r, d = self.radixs[i], self.dilations[i]
+        taps = x.unfold(1, (r - 1) * d + 1, 1)[..., ::d]
+        return taps.reshape(-1, taps.size(2) * r)
+
+    def _class_taps(self, x):
+        # x: (B, L) class indices in time order -> (B * predict_dist, radix) rows of the first layer's lookup table
+        r, d = self.radixs[0], self.dilations[0]
+        taps = x.unfold(1, (r - 1) * d + 1, 1)[..., ::d] + self.tap_offsets
+        return taps.reshape(-1, r)
+
+    def condition(self, h=None):
+        """Set the conditioning of the utterance to generate.
+
+        h: upsampled features of shape (B, aux_channels, T), column n conditions the n-th generated sample.
+        It is zero padded to a multiple of predict_dist. Pass None to start empty and feed the conditioning with
+        extend_condition() while generating.
+        """
+        self.cond = None
+        self.cond_base = self.cond_start = self.cond_end = 0
+        self.cond_proj = None
+        if h is not None:
+            self.extend_condition(h, last=True)
+
+    def extend_condition(self, h, last=False):
+        """Append upsampled conditioning of shape (B, aux_channels, T).
+
+        Columns that are no longer needed are dropped, so memory does not grow with the utterance length.
+        last=True zero pads the conditioning to a multiple of predict_dist.
+        """
+        if last:
+            h = F.pad(h, (0, -(self.cond_available + h.size(-1)) % self.predict_dist))
+        h = h.transpose(1, 2)
+        if self.cond is None:
+            self.cond = F.pad(h, (0, 0, self.cond_context, 0))
+        else:
+            self.cond = torch.cat((self.cond[:, self.written - self.cond_base:], h), 1)
+            self.cond_base = self.written
+
+    @property
+    def cond_available(self):
+        """Number of samples the conditioning received so far covers."""
+        if self.cond is None:
+            return 0
+        return self.cond_base + self.cond.size(1) - self.cond_context
+
+    def shrink(self, batch_size):
+        """Keep only the first batch_size utterances of the batch."""
+        self.buffers = [buf[:batch_size] for buf in self.buffers]
+        self.sampler.shrink(batch_size)
+        if self.cond is not None:
+            self.cond = self.cond[:batch_size]
+            if self.cond_proj is not None:
+                self.cond_proj = [z[:batch_size] for z in self.cond_proj]
+
+    def _project_block(self, start):
+        # V_lr outputs of every layer for samples [start, start + cond_block)
+        end = min(start + max(self.cond_block, self.predict_dist), self.cond_available)
+        if end < start + self.predict_dist:
+            raise ValueError("conditioning ends at sample {}, cannot generate sample {}.".format(
+                self.cond_available, start + self.predict_dist - 1))
+        n, ctx = end - start, self.cond_context
+        local = start - self.cond_base
+        proj = F.linear(self.cond[:, local:local + n + ctx], self.V_stack)
+        self.cond_proj = []
+        offset = 0
+        for i, (r, d) in enumerate(zip(self.radixs, self.dilations)):
+            z = self.V_lr[i].bias.expand(proj.size(0), n, -1)
+            for k in range(r):
+                shift = (r - 1 - k) * d
+                z = z + proj[:, ctx - shift:ctx - shift + n, offset:offset + self.channels]
+                offset += self.channels
+            self.cond_proj.append(z)
+        self.cond_start, self.cond_end = start, end
+
+    def step(self, samples):
+        """Feed the last predict_dist samples and return the logits of the next ones.
+
+        samples: LongTensor of shape (B, predict_dist).
+        Returns logits of shape (B, predict_dist, classes).
+        """
+        B = samples.size(0)
+        t = self.written
+        if self.cond is not None and t + self.predict_dist > self.cond_end:
+            self._project_block(t)
+        x = samples
+        for i in range(len(self.buffers)):
+            window = self._push(i, x)
+            if i:
+                z = self.W_lr[i](self._taps(window, i))
+            else:
+                z = self.W_lr[0](self._class_taps(window)) + self.W_lr_bias
+            if self.cond is not None:
+                z = z + self.cond_proj[i][:, t - self.cond_start:t - self.cond_start + self.predict_dist].reshape(
+                    -1, self.channels)
+            x = F.relu(self.W_o[i](F.relu(z))).view(B, self.predict_dist, -1)
+        self.written += self.predict_dist
+        return self.fc_out(x)
+
+    def one_sample_generate(self, samples, c=1., method='sampling'):
+        samples = self.sampler(self.step(samples.view(-1, self.predict_dist)), c, method).clone()
+        return samples.view(-1) if samples.size(0) == 1 else samples
+
+    def generate(self, n=None, h=None, c=1., method='sampling', seed=None):
+        """Generate one utterance, see general_FFTNet.fast_generate for the arguments."""
+        device = self.W_lr_bias.device
+        self.init_buf(seed=seed)
+        if h is not None:
+            h = h.view(1, h.size(-2), h.size(-1)).to(device)
+            n = h.size(-1) if n is None else n
+            self.condition(h[:, :, :n])
+        steps = -(-n // self.predict_dist)
+        if torch.is_tensor(c):
+            c = F.pad(c.to(device).view(-1)[:n], (0, steps * self.predict_dist - min(n, c.numel())), value=1.)
+            c = c.view(steps, 1, self.predict_dist, 1)
+        else:
+            c = [c] * steps
+
+        output = torch.empty(steps, self.predict_dist, dtype=torch.long, device=device)
+        samples = torch.zeros(1, self.predict_dist, dtype=torch.long, device=device)
+        with torch.no_grad():
+            for t in range(steps):
+                samples = self.sampler(self.step(samples), c[t], method)
+                output[t] = samples[0]
+        return output.view(-1)[:n]
+
+    def batch_generate(self, hs=None, lengths=None, c=1., method='sampling', seed=None):
+        """Generate several utterances in one autoregressive loop.
+
+        hs: list of upsampled conditioning of shape (aux_channels, T_b), lengths may differ.
+        lengths: number of samples of each utterance, only needed for unconditional models.
+        c, method: one value for all utterances or a list with one value per utterance.
+        seed: seed of the random numbers used for sampling.
+        The utterances advance together and leave the batch as soon as they are finished.
+        Returns a list of LongTensors, one per utterance.
+        """
+        if hs is not None:
+            lengths = [h.size(-1) for h in hs]
+        B = len(lengths)
+        c = list(c) if isinstance(c, (list, tuple)) else [c] * B
+        method = list(method) if isinstance(method, (list, tuple)) else [method] * B
+        device = self.W_lr_bias.device
+
+        # longest first, so the unfinished utterances are always the head of the batch
+        order = sorted(range(B), key=lambda b: -lengths[b])
+        lengths = [lengths[b] for b in order]
+        T = -(-lengths[0] // self.predict_dist) * self.predict_dist
+        greedy = [method[b] == 'argmax' for b in order]
+        sampling = [m for m in method if m != 'argmax']
+        sampling = sampling[0] if sampling else 'argmax'
+        self.init_buf(B, seed=seed, greedy=greedy)
+        if hs is not None:
+            h = torch.zeros(B, hs[0].size(0), T, device=device)
+            for i, b in enumerate(order):
+                h[i, :, :lengths[i]] = hs[b]
+            self.condition(h)
+        c = torch.tensor([c[b] for b in order], device=device).view(B, 1, 1)
+
+        output = torch.empty(B, T, dtype=torch.long, device=device)
+        samples = torch.zeros(B, self.predict_dist, dtype=torch.long, device=device)
+        active = B
+        for t in range(0, T, self.predict_dist):
+            if lengths[active - 1] <= t:
+                while lengths[active - 1] <= t:
+                    active -= 1
+                self.shrink(active)
+                samples, c = samples[:active], c[:active]
+            samples = self.sampler(self.step(samples), c, sampling)
+            output[:active, t:t + self.predict_dist] = samples
+
+        generation = [None] * B
+        for i, b in enumerate(order):
+            generation[b] = output[i, :lengths[i]]
+        return generation
+
+    def quantized(self):
+        """Return a copy whose W_lr, W_o and fc_out matrices hold int8 weights with per-channel scales.
+
+        Activations are quantized on the fly at every step, so no calibration data is needed. The first layer's
+        lookup table and the conditioning projections, computed once per block, stay in float.
+        It only pays off for batch_generate with large batches: at batch size 1 the matrices are too small and the
+        quantized operations cost more than the float ones, with calibrated activation scales as well.
+        """
+        qconfig = torch.quantization.per_channel_dynamic_qconfig
+        spec = {'fc_out': qconfig}
+        for i in range(len(self.W_o)):
+            spec['W_o.{}'.format(i)] = qconfig
+            if i:
+                spec['W_lr.{}'.format(i)] = qconfig
+        return torch.quantization.quantize_dynamic(self, spec, dtype=torch.qint8)
@@ -0,0 +1,73 @@
+import csv
+import json
+from time import perf_counter
+
+
+class Training_Metrics:
+    """Loss and throughput of training, reported every log_step steps.
+
+    The losses are summed on their device and only read at a report, so there is one device sync per log_step steps
+    instead of one per step. The time of a report interval is split into the time spent waiting for the data loader
+    and the rest, which is the compute time of the steps (the sync of the report waits for the device to finish).
+    samples_per_step: audio samples trained on per step, batch_size * seq_M * number of processes.
+    filename: also append the reports to it, as csv if it ends with .csv, else as json lines.
+    """
+
+    fields = ['step', 'loss', 'steps_per_sec', 'samples_per_sec', 'data_ms', 'compute_ms', 'data_fraction']
+
+    def __init__(self, samples_per_step, log_step=100, filename=None):
+        self.samples_per_step = samples_per_step
+        self.log_step = log_step
+        self.filename = filename
+        if filename is not None and filename.endswith('.csv'):
+            with open(filename, 'a', newline='') as f:
+                if not f.tell():
+                    csv.writer(f).writerow(self.fields)
+        self._reset()
+
+    def _reset(self):
+        self.loss = None
+        self.steps = 0
+        self.wait = 0.
+        self.start = perf_counter()
+
+    def timed(self, loader):
+        """Iterate over loader, adding the time spent in it, from starting its workers on, to the data wait."""
+        a = perf_counter()
+        batches = iter(loader)
+        while True:
+            try:
+                batch = next(batches)
+            except StopIteration:
+                self.wait += perf_counter() - a
+                return
+            self.wait += perf_counter() - a
+            yield batch
+            a = perf_counter()
+
+    def step(self, step, loss):
+        """Record the loss of step, reporting when log_step steps were recorded since the last report."""
+        loss = loss.detach().float()
+        self.loss = loss if self.loss is None else self.loss + loss
+        self.steps += 1
+        if self.steps == self.log_step:
+            self.report(step)
+
+    def report(self, step):
+        if not self.steps:
+            return
+        loss = self.loss.item() / self.steps
+        elapsed = perf_counter() - self.start
+        row = dict(step=step, loss=loss, steps_per_sec=self.steps / elapsed,
+                   samples_per_sec=self.steps * self.samples_per_step / elapsed,
+                   data_ms=1000 * self.wait / self.steps, compute_ms=1000 * (elapsed - self.wait) / self.steps,
+                   data_fraction=self.wait / elapsed)
+        print("step {step}: loss {loss:.4f}, {samples_per_sec:.0f} samples/sec, data {data_ms:.1f} ms/step "
+              "({data_fraction:.0%}), compute {compute_ms:.1f} ms/step".format(**row))
+        if self.filename is not None:
+            with open(self.filename, 'a', newline='') as f:
+                if self.filename.endswith('.csv'):
+                    csv.writer(f).writerow([row[k] for k in self.fields])
+                else:
+                    f.write(json.dumps(row) + '\n')
+        self._reset()
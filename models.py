@@ -1,9 +1,14 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from operator import mul
 from functools import reduce
+from datetime import datetime
+
+from incremental import Incremental_FFTNet
+from profiling import conv_flops, linear_flops, _run
 
 
 class One_Hot(nn.Module):
@@ -17,6 +22,10 @@ class One_Hot(nn.Module):
 
 
 class general_FFTLayer(nn.Module):
+    # set by general_FFTNet.set_profiler
+    profiler = None
+    profile_name = 'fft_layer'
+
     def __init__(self, in_channels, out_channels, N, *, radix=2, aux_channels=None):
         super().__init__()
         self.in_channels = in_channels
@@ -33,19 +42,51 @@ class general_FFTLayer(nn.Module):
 
     def forward(self, x, h=None, zeropad=True, input_onehot=False):
         M = x.size(-1)
+        if not x.is_floating_point():
+            return self._class_forward(x, h, zeropad)
+        run = self.profiler or _run
+
         x = self.pad(x) if zeropad else x
         if input_onehot:
             x[:, self.in_channels // 2, :x.size(2) - M] = 1
 
-        if h is None:
-            z = F.relu(self.W_lr(x))
-        else:
+        z = run(self.profile_name + '.W_lr', self.W_lr, x, flops=lambda out: conv_flops(self.W_lr, out))
+        if h is not None:
             h = self.pad(h[:, :, -M:]) if zeropad else h[:, :, -M:]
-            z = F.relu(self.W_lr(x) + self.V_lr(h))
-        return F.relu(self.W_o(z))
+            z = z + run(self.profile_name + '.V_lr', self.V_lr, h, flops=lambda out: conv_flops(self.V_lr, out))
+        z = run(self.profile_name + '.W_o', self.W_o, F.relu(z), flops=lambda out: conv_flops(self.W_o, out))
+        return F.relu(z)
+
+    def _class_forward(self, x, h=None, zeropad=True):
+        # x holds class indices of shape (B, T); summing the W_lr columns picked by each tap equals convolving the
+        # one-hot input, zero padding is done with the center class like input_onehot does
+        M = x.size(-1)
+        run = self.profiler or _run
+        dilation = self.W_lr.dilation[0]
+        if zeropad:
+            x = F.pad(x, (self.pad.padding[0], 0), value=self.in_channels // 2)
+        T = x.size(1) - (self.radix - 1) * dilation
+
+        def lookup(x):
+            idx = torch.stack([x[:, k * dilation:k * dilation + T] + k * self.in_channels
+                               for k in range(self.radix)], -1)
+            table = self.W_lr.weight.permute(2, 1, 0).reshape(-1, self.out_channels)
+            z = F.embedding_bag(idx.view(-1, self.radix), table, mode='sum').view(-1, T, self.out_channels)
+            return (z + self.W_lr.bias).transpose(1, 2)
+
+        z = run(self.profile_name + '.W_lr', lookup, x, flops=lambda out: out.numel() * self.radix)
+        if h is not None:
+            h = self.pad(h[:, :, -M:]) if zeropad else h[:, :, -M:]
+            z = z + run(self.profile_name + '.V_lr', self.V_lr, h, flops=lambda out: conv_flops(self.V_lr, out))
+        z = run(self.profile_name + '.W_o', self.W_o, F.relu(z), flops=lambda out: conv_flops(self.W_o, out))
+        return F.relu(z)
 
 
 class general_FFTNet(nn.Module):
+    profiler = None
+    # set by set_recompute
+    recompute = 0
+
     def __init__(self, radixs=[2] * 11, fft_channels=128, classes=256, *, aux_channels=None, transpose=False,
                  predict_dist=1):
         super().__init__()
@@ -61,9 +102,6 @@ class general_FFTNet(nn.Module):
         self.radixs = radixs
         self.N_seq = N_seq
 
-        # transform input to one hot
-        self.one_hot = One_Hot(classes)
-
         self.fft_layers = nn.ModuleList()
         in_channels = classes
         for N, r in zip(N_seq, radixs):
@@ -71,59 +109,138 @@ class general_FFTNet(nn.Module):
             in_channels = fft_channels
         self.fc_out = nn.Linear(in_channels, classes)
 
-    def forward(self, x, h=None, zeropad=True):
-        x = self.one_hot(x).transpose(1, 2)
+    def forward(self, x, h=None, zeropad=True, targets=None, loss_chunk=1024):
+        """Logits of shape (B, classes, T), or with targets of shape (B, T), the mean cross entropy of predicting
+        them, computed without the logits of the whole sequence (see chunked_loss)."""
+        run = self.profiler or _run
+        if self.profiler is not None:
+            self.profiler.category = 'forward'
         first_layer = True
 
-        for fft_layer in self.fft_layers:
-            x = fft_layer(x, h, zeropad, first_layer)
-            first_layer = False
+        if self.recompute and self.training and torch.is_grad_enabled():
+            for i in range(0, len(self.fft_layers), self.recompute):
+                x = checkpoint(self._layers_forward, i, x, h, zeropad, use_reentrant=False)
+        else:
+            for fft_layer in self.fft_layers:
+                x = fft_layer(x, h, zeropad, first_layer)
+                first_layer = False
 
-        x = self.fc_out(x.transpose(1, 2))
+        if targets is not None:
+            return self.chunked_loss(x, targets, loss_chunk)
+        x = run('fc_out', self.fc_out, x.transpose(1, 2), flops=lambda out: linear_flops(self.fc_out, out))
         return x.transpose(1, 2)
 
+    def _chunk_loss(self, x, targets):
+        # fc_out as a 1x1 convolution keeps the (B, C, T) layout
+        logits = F.conv1d(x, self.fc_out.weight.unsqueeze(-1), self.fc_out.bias)
+        return F.cross_entropy(logits, targets, reduction='sum')
+
+    def chunked_loss(self, x, targets, chunk=1024):
+        """Mean cross entropy of fc_out of the last layer output x, over chunks of chunk steps, 0 for a single one.
+
+        With gradients, every chunk is checkpointed, so backward computes the logits of one chunk at a time again
+        instead of keeping the logits and softmax of the whole sequence.
+        """
+        loss = 0
+        chunk = chunk or x.size(2)
+        for i in range(0, x.size(2), chunk):
+            args = (x[:, :, i:i + chunk], targets[:, i:i + chunk])
+            if chunk < x.size(2) and torch.is_grad_enabled():
+                loss = loss + checkpoint(self._chunk_loss, *args, use_reentrant=False)
+            else:
+                loss = loss + self._chunk_loss(*args)
+        return loss / targets.numel()
+
+    def _layers_forward(self, i, x, h, zeropad):
+        # the group of recompute layers starting at i
+        for j, fft_layer in enumerate(self.fft_layers[i:i + self.recompute], i):
+            x = fft_layer(x, h, zeropad, j == 0)
+        return x
+
+    def set_recompute(self, group):
+        """In training, keep only the output of every group of layers for backward and compute the activations inside
+        a group again when backward reaches it. Backward then holds the group outputs plus the activations of one
+        group, for the cost of about one more forward pass per step. group=1 checkpoints every layer, 0 turns it off.
+        """
+        self.recompute = group
+
+    def set_profiler(self, profiler):
+        """Report every operation of forward and one_sample_generate to profiler (see profiling.Profiler), None
+        to stop."""
+        self.profiler = profiler
+        for i, fft_layer in enumerate(self.fft_layers):
+            fft_layer.profiler = profiler
+            fft_layer.profile_name = 'fft_layers.{}'.format(i)
+
     def get_receptive_field(self):
         return self.r_field
 
     def get_predict_distance(self):
         return self.predict_dist
 
+    def get_config(self):
+        """Arguments that build this model again with general_FFTNet(**config)."""
+        return dict(radixs=list(self.radixs), fft_channels=self.channels, classes=self.classes,
+                    aux_channels=self.aux_channels, transpose=len(self.radixs) > 1 and self.N_seq[0] == self.radixs[0],
+                    predict_dist=self.predict_dist)
+
     def conditional_sampling(self, logits):
-        probs = F.softmax(logits, dim=1)
+        probs = F.softmax(logits, dim=-1)
         dist = torch.distributions.Categorical(probs)
         return dist.sample()
 
     def argmax(self, logits):
-        _, sample = logits.max(1)
+        _, sample = logits.max(-1)
         return sample
 
-    def init_buf(self):
-        if next(self.parameters()).is_cuda:
-            device = 'cuda'
-        else:
-            device = 'cpu'
-
-        if hasattr(self, "buffers"):
-            for buf in self.buffers:
-                buf.fill_(0.).to(device)
-        else:
-            self.buffers = [
-                torch.zeros(1, self.classes,
-                            self.N_seq[0] - self.N_seq[0] // self.radixs[0] + self.predict_dist).float().to(device)]
-            self.buffers += [torch.zeros(1, self.channels, N - N // r + self.predict_dist).float().to(device) for N, r
-                             in zip(self.N_seq[1:], self.radixs[1:])]
-        self.buffers[0][:, self.classes // 2] = 1
+    def init_buf(self, batch_size=1):
+        device = next(self.parameters()).device
+        # the first layer buffers class indices, padded with the center class
+        self.gen_bufs = [torch.full((batch_size, self.N_seq[0] - self.N_seq[0] // self.radixs[0] + self.predict_dist),
+                                    self.classes // 2, dtype=torch.long, device=device)]
+        self.gen_bufs += [torch.zeros(batch_size, self.channels, N - N // r + self.predict_dist, device=device) for
+                          N, r in zip(self.N_seq[1:], self.radixs[1:])]
 
     def one_sample_generate(self, samples, h=None, c=1., method='sampling'):
-        samples = self.one_hot(samples).t()
-        for i in range(len(self.buffers)):
-            torch.cat((self.buffers[i][:, :, self.predict_dist:], samples.view(1, -1, self.predict_dist)), 2,
-                      out=self.buffers[i])
-            samples = self.fft_layers[i](self.buffers[i], h, False)
-
-        logits = self.fc_out(samples.transpose(1, 2)).view(self.predict_dist, self.classes) * c
+        """samples has shape (predict_dist,), or (B, predict_dist) after init_buf(B); the output has the same shape.
+
+        c can be a tensor of shape (B, 1, 1) to use a different constant per utterance.
+        """
+        run = self.profiler or _run
+        if self.profiler is not None:
+            self.profiler.category = 'generate'
+        shape = samples.shape
+        for i, buf in enumerate(self.gen_bufs):
+            self.gen_bufs[i] = run('fft_layers.{}.shift'.format(i), torch.cat,
+                                   (buf[..., self.predict_dist:], samples.view(buf.shape[:-1] + (self.predict_dist,))),
+                                   -1)
+            samples = self.fft_layers[i](self.gen_bufs[i], h, False)
+
+        logits = run('fc_out', self.fc_out, samples.transpose(1, 2), flops=lambda out: linear_flops(self.fc_out, out))
+        samples = run('sampling', self._sample, logits, c, method, flops=lambda out: 5 * logits.numel())
+        return samples.view(shape)
+
+    def _sample(self, logits, c, method):
         if method == 'argmax':
-            samples = self.argmax(logits)
-        else:
-            samples = self.conditional_sampling(logits)
-        return samples
\ No newline at end of file
+            return self.argmax(logits * c)
+        return self.conditional_sampling(logits * c)
+
+    def fast_generate(self, n=None, h=None, c=1., method='sampling', seed=None, verbose=True):
+        """Generate a whole utterance with the incremental engine.
+
+        n: number of samples to generate, defaults to the length of h.
+        h: upsampled conditioning of shape (aux_channels, T) or (1, aux_channels, T).
+        c: constant multiplied before softmax, a float or a tensor with one value per sample.
+        method: 'sampling', 'cdf' or 'argmax', see sampling.Sampler.
+        seed: seed of the random numbers used for sampling.
+        Returns a LongTensor of n samples. The speed in samples/sec is kept in self.generation_speed and printed
+        if verbose.
+        """
+        engine = Incremental_FFTNet(self)
+        a = datetime.now()
+        output = engine.generate(n, h, c, method, seed)
+        cost = (datetime.now() - a).total_seconds()
+        self.generation_speed = output.size(0) / cost if cost > 0 else float('inf')
+        if verbose:
+            print("Speed:", self.generation_speed, "samples/sec.")
+        return output
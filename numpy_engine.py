@@ -0,0 +1,184 @@
+import numpy as np
+
+
+def export_weights(net, filename):
+    """Save a trained general_FFTNet to an npz file that Numpy_FFTNet can load without torch."""
+    arrays = {name: value.detach().cpu().numpy() for name, value in net.state_dict().items()
+              if not name.startswith('one_hot')}
+    np.savez(filename, radixs=np.array(net.radixs), N_seq=np.array(net.N_seq), predict_dist=net.predict_dist,
+             **arrays)
+
+
+class Numpy_FFTNet:
+    """Step-by-step FFTNet generation with preallocated NumPy arrays and BLAS calls only.
+
+    filename: weights written by export_weights, for any radix, transposed or not, and any predict_dist.
+    It follows the same scheme as Incremental_FFTNet: mirrored circular buffers per layer, a lookup table for the
+    first layer and conditioning projected ahead of the sample loop in blocks of cond_block samples, so with argmax
+    it generates the same samples as the torch engine.
+    """
+
+    def __init__(self, filename, cond_block=2048):
+        data = np.load(filename)
+        self.radixs = [int(r) for r in data['radixs']]
+        self.predict_dist = int(data['predict_dist'])
+        self.dilations = [int(N) // r for N, r in zip(data['N_seq'], self.radixs)]
+        self.buf_lens = [(r - 1) * d + self.predict_dist for r, d in zip(self.radixs, self.dilations)]
+        self.cond_block = cond_block
+
+        def weight(i, name):
+            return data['fft_layers.{}.{}.weight'.format(i, name)].astype(np.float32)
+
+        def bias(i, name):
+            return data['fft_layers.{}.{}.bias'.format(i, name)].astype(np.float32)
+
+        # conv kernels (out, in, radix) become (radix * in, out) matrices that multiply the taps laid out as (radix, in)
+        W = weight(0, 'W_lr')
+        self.channels, self.classes = W.shape[:2]
+        self.table = np.ascontiguousarray(W.transpose(2, 1, 0).reshape(-1, self.channels))
+        self.tap_offsets = np.arange(self.radixs[0]) * self.classes
+        self.W_lr = [None] + [np.ascontiguousarray(weight(i, 'W_lr').transpose(2, 1, 0).reshape(-1, self.channels))
+                              for i in range(1, len(self.radixs))]
+        self.W_lr_b = [bias(i, 'W_lr') for i in range(len(self.radixs))]
+        self.W_o = [np.ascontiguousarray(weight(i, 'W_o')[:, :, 0].T) for i in range(len(self.radixs))]
+        self.W_o_b = [bias(i, 'W_o') for i in range(len(self.radixs))]
+        self.fc_out = np.ascontiguousarray(data['fc_out.weight'].astype(np.float32).T)
+        self.fc_out_b = data['fc_out.bias'].astype(np.float32)
+
+        self.conditional = 'fft_layers.0.V_lr.weight' in data
+        if self.conditional:
+            self.V_stack = np.ascontiguousarray(np.concatenate(
+                [weight(i, 'V_lr').transpose(1, 2, 0).reshape(weight(i, 'V_lr').shape[1], -1)
+                 for i in range(len(self.radixs))], axis=1))
+            self.V_lr_b = [bias(i, 'V_lr') for i in range(len(self.radixs))]
+            self.cond_context = max((r - 1) * d for r, d in zip(self.radixs, self.dilations))
+        # rows of a layer window read by each new column: tap k of column j is row j + k * dilation
+        self.tap_rows = [np.arange(self.predict_dist)[:, None] + np.arange(r) * d
+                         for r, d in zip(self.radixs, self.dilations)]
+        self.cond = None
+
+    def init_buf(self, batch_size=1, seed=None):
+        """Reset the state and allocate every array used by a step."""
+        B, p, C = batch_size, self.predict_dist, self.channels
+        self.buffers = [np.full((B, 2 * self.buf_lens[0]), self.classes // 2, dtype=np.int64)]
+        self.buffers += [np.zeros((B, 2 * L, C), dtype=np.float32) for L in self.buf_lens[1:]]
+        self.idx = np.empty((B, p, self.radixs[0]), dtype=np.int64)
+        self.gathered = np.empty((B, p, self.radixs[0], C), dtype=np.float32)
+        self.taps = [None] + [np.empty((B, p, r, C), dtype=np.float32) for r in self.radixs[1:]]
+        self.z = np.empty((B * p, C), dtype=np.float32)
+        self.x = np.empty((B * p, C), dtype=np.float32)
+        self.logits = np.empty((B * p, self.classes), dtype=np.float32)
+        self.scaled = np.empty((B, p, self.classes), dtype=np.float32)
+        self.samples = np.empty((B, p), dtype=np.int64)
+        self.rng = np.random.default_rng(seed)
+        self.noise, self.noise_pos = None, 0
+        self.written = 0
+        self.cond = None
+
+    def _push(self, i, x):
+        # write x (B, predict_dist, ...) at the write index of layer i and return the last buf_lens[i] columns
+        buf, L = self.buffers[i], self.buf_lens[i]
+        start = self.written % L
+        end = start + x.shape[1]
+        if end <= L:
+            buf[:, start:end] = x
+            buf[:, start + L:end + L] = x
+        else:
+            split = L - start
+            buf[:, start:L] = x[:, :split]
+            buf[:, start + L:] = x[:, :split]
+            buf[:, :end - L] = x[:, split:]
+            buf[:, L:end] = x[:, split:]
+        return buf[:, end % L:end % L + L]
+
+    def condition(self, h):
+        """h: upsampled features of shape (B, aux_channels, T), column n conditions the n-th generated sample."""
+        h = np.asarray(h, dtype=np.float32)
+        pad = -h.shape[-1] % self.predict_dist
+        self.cond = np.zeros((h.shape[0], self.cond_context + h.shape[-1] + pad, h.shape[1]), dtype=np.float32)
+        self.cond[:, self.cond_context:self.cond_context + h.shape[-1]] = h.transpose(0, 2, 1)
+        self.cond_start = self.cond_end = 0
+
+    def _project_block(self, start):
+        # V_lr outputs of every layer for samples [start, start + cond_block), one GEMM for all layers and taps
+        end = min(start + max(self.cond_block, self.predict_dist), self.cond.shape[1] - self.cond_context)
+        n, ctx = end - start, self.cond_context
+        proj = np.dot(self.cond[:, start:end + ctx], self.V_stack)
+        self.cond_proj = []
+        offset = 0
+        for i, (r, d) in enumerate(zip(self.radixs, self.dilations)):
+            z = np.broadcast_to(self.V_lr_b[i], (proj.shape[0], n, self.channels)).copy()
+            for k in range(r):
+                shift = (r - 1 - k) * d
+                z += proj[:, ctx - shift:ctx - shift + n, offset:offset + self.channels]
+                offset += self.channels
+            self.cond_proj.append(z)
+        self.cond_start, self.cond_end = start, end
+
+    def step(self, samples):
+        """samples: int array of shape (B, predict_dist). Returns logits of shape (B * predict_dist, classes)."""
+        p, B = self.predict_dist, samples.shape[0]
+        t = self.written
+        if self.cond is not None and t + p > self.cond_end:
+            self._project_block(t)
+        x = samples
+        for i in range(len(self.buffers)):
+            window = self._push(i, x)
+            z = self.z
+            if i:
+                np.take(window, self.tap_rows[i], axis=1, out=self.taps[i], mode='clip')
+                np.dot(self.taps[i].reshape(B * p, -1), self.W_lr[i], out=z)
+            else:
+                np.take(window, self.tap_rows[0], axis=1, out=self.idx, mode='clip')
+                self.idx += self.tap_offsets
+                np.take(self.table, self.idx, axis=0, out=self.gathered, mode='clip')
+                self.gathered.sum(axis=2, out=z.reshape(B, p, -1))
+            z += self.W_lr_b[i]
+            if self.cond is not None:
+                z.reshape(B, p, -1)[:] += self.cond_proj[i][:, t - self.cond_start:t - self.cond_start + p]
+            np.maximum(z, 0., out=z)
+            np.dot(z, self.W_o[i], out=self.x)
+            self.x += self.W_o_b[i]
+            np.maximum(self.x, 0., out=self.x)
+            x = self.x.reshape(B, p, -1)
+        self.written += p
+        np.dot(self.x, self.fc_out, out=self.logits)
+        self.logits += self.fc_out_b
+        return self.logits
+
+    def sample(self, logits, c=1., method='sampling'):
+        """Gumbel-max sampling with noise drawn in blocks, or argmax. Returns a (B, predict_dist) buffer."""
+        np.multiply(logits.reshape(self.scaled.shape), c, out=self.scaled)
+        if method != 'argmax':
+            if self.noise is None or self.noise_pos == len(self.noise):
+                self.noise = -np.log(-np.log(self.rng.random((256,) + self.scaled.shape, dtype=np.float32)))
+                self.noise_pos = 0
+            self.scaled += self.noise[self.noise_pos]
+            self.noise_pos += 1
+        return self.scaled.argmax(-1, out=self.samples)
+
+    def generate(self, n=None, h=None, c=1., method='sampling', seed=None):
+        """Generate one utterance, like general_FFTNet.fast_generate.
+
+        n: number of samples, defaults to the length of h. h: conditioning of shape (aux_channels, T).
+        c: a float or an array with one value per sample. Returns an int64 array of n classes.
+        """
+        p = self.predict_dist
+        self.init_buf(seed=seed)
+        if h is not None:
+            h = np.asarray(h).reshape(1, -1, np.shape(h)[-1])
+            n = h.shape[-1] if n is None else n
+            self.condition(h[:, :, :n])
+        steps = -(-n // p)
+        if np.ndim(c):
+            c = np.pad(np.asarray(c, dtype=np.float32)[:n], (0, steps * p - min(n, len(c))), 'constant',
+                       constant_values=1.).reshape(steps, 1, p, 1)
+        else:
+            c = [c] * steps
+
+        output = np.empty((steps, p), dtype=np.int64)
+        samples = np.zeros((1, p), dtype=np.int64)
+        for t in range(steps):
+            samples = self.sample(self.step(samples), c[t], method)
+            output[t] = samples[0]
+        return output.reshape(-1)[:n]
@@ -1,7 +1,8 @@
 import os
 import sys
+import hashlib
 from multiprocessing import Pool, cpu_count
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from functools import partial
 from tqdm import tqdm
 from itertools import repeat
@@ -11,16 +12,23 @@ from librosa.util import frame
 import pyworld as world
 import pysptk as sptk
 import numpy as np
-from utils import repeat_last_padding, encoder
-from sklearn.preprocessing import StandardScaler
+from utils import repeat_last_padding, encoder, Running_Stats
+from dataset import Packed_Writer, Packed_Corpus
 
 
-def get_features(filename, *, winlen, winstep, n_mcep, mcep_alpha, minf0, maxf0, type):
-    wav, sr = load(filename, sr=None)
+def world_features(x, sr, *, winlen, winstep, n_mcep, mcep_alpha, minf0, maxf0, type, f0_method='harvest'):
+    """Features of the signal x, one column per frame placed every winstep seconds from 0.
 
+    f0_method: 'harvest', or 'dio' which is many times faster with slightly more F0 errors, both refined with
+    stonemask.
+    """
     # get f0
-    x = wav.astype(float)
-    _f0, t = world.harvest(x, sr, f0_floor=minf0, f0_ceil=maxf0, frame_period=winstep * 1000)
+    if f0_method == 'dio':
+        _f0, t = world.dio(x, sr, f0_floor=minf0, f0_ceil=maxf0, frame_period=winstep * 1000)
+    elif f0_method == 'harvest':
+        _f0, t = world.harvest(x, sr, f0_floor=minf0, f0_ceil=maxf0, frame_period=winstep * 1000)
+    else:
+        raise ValueError("F0 method " + f0_method + " is not implemented.")
     f0 = world.stonemask(x, _f0, t, sr)
 
     window_size = int(sr * winlen)
@@ -32,70 +40,177 @@ def get_features(filename, *, winlen, winstep, n_mcep, mcep_alpha, minf0, maxf0,
         h = sptk.sp2mc(spec, n_mcep - 1, mcep_alpha).T
     else:
         h = mfcc(x, sr, n_mfcc=n_mcep, n_fft=window_size, hop_length=hop_size)
-    h = np.vstack((h, f0))
+    return np.vstack((h, f0))
+
+
+def _chunk_features(args):
+    x, sr, params = args
+    return world_features(x, sr, **params)
+
+
+def chunked_features(x, sr, *, chunk_length, margin=0.3, executor=None, **params):
+    """world_features computed on chunks of about chunk_length seconds, in parallel if executor is given.
+
+    Chunks start at frame boundaries and read margin seconds of signal on both sides, which are cut off again, so
+    every frame is computed with the same signal around it as in one pass, apart from frames near the chunk edges
+    that F0 tracking smooths over.
+    """
+    hop_size = int(sr * params['winstep'])
+    frames = len(x) // hop_size + 1
+    chunk_frames = max(1, int(chunk_length * sr) // hop_size)
+    margin_frames = int(np.ceil(margin * sr / hop_size))
+    starts = list(range(0, frames, chunk_frames))
+    jobs = []
+    for start in starts:
+        begin = max(0, start - margin_frames)
+        jobs.append((x[begin * hop_size:(start + chunk_frames + margin_frames) * hop_size], sr, params))
+    results = executor.map(_chunk_features, jobs) if executor is not None else map(_chunk_features, jobs)
+    h = np.concatenate([h[:, start - max(0, start - margin_frames):][:, :chunk_frames]
+                        for start, h in zip(starts, results)], axis=1)
+    return h[:, :frames]
+
+
+def get_features(filename, *, winlen, winstep, n_mcep, mcep_alpha, minf0, maxf0, type, f0_method='harvest',
+                 chunk_length=None, executor=None):
+    """chunk_length: split files longer than chunk_length seconds into chunks, see chunked_features."""
+    wav, sr = load(filename, sr=None)
+    x = wav.astype(float)
+    params = dict(winlen=winlen, winstep=winstep, n_mcep=n_mcep, mcep_alpha=mcep_alpha, minf0=minf0, maxf0=maxf0,
+                  type=type, f0_method=f0_method)
+    if chunk_length is not None and len(x) > chunk_length * sr:
+        h = chunked_features(x, sr, chunk_length=chunk_length, executor=executor, **params)
+    else:
+        h = world_features(x, sr, **params)
+
+    hop_size = int(sr * winstep)
     maxlen = len(x) // hop_size + 2
     h = repeat_last_padding(h, maxlen)
     id = os.path.basename(filename).replace(".wav", "")
     return (id, x, h)
 
 
-def calc_stats(npzfile, out_dir):
-    scaler = StandardScaler()
-    data_dict = np.load(npzfile)
-    for name, x in data_dict.items():
-        if name[-2:] == '_h':
-            scaler.partial_fit(x.T)
+# change it when get_features changes, to invalidate the cached features
+FEATURE_VERSION = 1
+
 
-    mean = scaler.mean_
-    scale = scaler.scale_
+def feature_key(filename, **params):
+    """Hash of the content of filename and the feature parameters."""
+    key = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            key.update(block)
+    key.update(repr((FEATURE_VERSION, sorted(params.items()))).encode())
+    return key.hexdigest()
+
+
+def cached_features(filename, cache_dir, *, q_channels, **feature_params):
+    """get_features with the encoded audio, stored in cache_dir under the feature_key of the file together with the
+    Running_Stats of the features.
+
+    Returns (id, encoded audio, features, feature statistics, whether it was cached).
+    """
+    path = os.path.join(cache_dir, feature_key(filename, q_channels=q_channels, **feature_params) + '.npz')
+    if os.path.exists(path):
+        # entries are shared by files with the same content, the id comes from the file name
+        cached = np.load(path)
+        if 'stats_count' in cached:
+            stats = Running_Stats(cached['stats_count'], cached['stats_mean'], cached['stats_m2'])
+        else:
+            stats = Running_Stats.from_array(cached['features'].T)
+        return os.path.basename(filename).replace(".wav", ""), cached['audio'], cached['features'], stats, True
+
+    id, x, h = get_features(filename, **feature_params)
+    audio = encoder(q_channels)(x).astype(np.uint8)
+    stats = Running_Stats.from_array(h.T)
+    # write to a temporary file first, so an interrupted run never leaves a broken entry
+    tmp = path + '.{}.tmp'.format(os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, audio=audio, features=h, stats_count=stats.count, stats_mean=stats.mean, stats_m2=stats.m2)
+    os.replace(tmp, path)
+    return id, audio, h, stats, False
+
+
+def calc_stats(data_dir, out_dir, split='train', chunk_frames=2 ** 20):
+    """Save the mean and scale of the features of a packed split, from the statistics gathered while it was written,
+    or from a pass over its features for splits written without them."""
+    corpus = Packed_Corpus(data_dir, split)
+    stats = corpus.stats
+    if stats is None:
+        stats = Running_Stats()
+        features = corpus.all_features
+        for i in range(0, len(features), chunk_frames):
+            stats.update(features[i:i + chunk_frames])
+
+    mean = stats.mean
+    scale = stats.scale
 
     np.savez(os.path.join(out_dir, 'scaler.npz'), mean=np.float32(mean), scale=np.float32(scale))
 
 
-def preprocess_cmu(wav_dir, output, *, q_channels, winlen, winstep, n_mcep, mcep_alpha, minf0, maxf0, type):
+def preprocess_cmu(wav_dir, output, *, q_channels, winlen, winstep, n_mcep, mcep_alpha, minf0, maxf0, type,
+                   feature_dtype=np.float32, cache_dir=None, resume=True, f0_method='harvest'):
+    """Features of every file are cached in cache_dir (default output/cache), so running it again only computes the
+    features of new or modified files, or of every file if a feature parameter changed.
+
+    At most two tasks per process are in flight, and results are appended to the packed split as they complete. With
+    resume, a split interrupted with the same parameters continues from its manifest instead of starting over.
+    """
     in_dir = os.path.join(wav_dir)
     out_dir = os.path.join(output)
-    train_data = os.path.join(out_dir, 'train.npz')
-    test_data = os.path.join(out_dir, 'test.npz')
+    cache_dir = os.path.join(out_dir, 'cache') if cache_dir is None else cache_dir
     os.makedirs(out_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
 
     files = [os.path.join(in_dir, f) for f in os.listdir(in_dir)]
     files.sort()
     train_files = files[:1032]
     test_files = files[1032:]
 
-    feature_fn = partial(get_features, winlen=winlen, winstep=winstep, n_mcep=n_mcep, mcep_alpha=mcep_alpha,
-                         minf0=minf0, maxf0=maxf0, type=type)
-    n_workers = cpu_count() // 2
+    params = dict(q_channels=q_channels, winlen=winlen, winstep=winstep, n_mcep=n_mcep, mcep_alpha=mcep_alpha,
+                  minf0=minf0, maxf0=maxf0, type=type)
+    # only set when it differs from the default, so existing cache entries stay valid
+    if f0_method != 'harvest':
+        params['f0_method'] = f0_method
+    feature_fn = partial(cached_features, cache_dir=cache_dir, **params)
+    n_workers = max(1, cpu_count() // 2)
     print("Running", n_workers, "processes.")
 
-    data_dict = {}
-    enc = encoder(q_channels)
-    print("Processing training data ...")
-    with ProcessPoolExecutor(n_workers) as executor:
-        futures = [executor.submit(feature_fn, f) for f in train_files]
-        for future in tqdm(futures):
-            name, data, feature = future.result()
-            data_dict[name] = enc(data).astype(np.uint8)
-            data_dict[name + '_h'] = feature
-    np.savez(train_data, **data_dict)
-
-    data_dict = {}
-    print("Processing test data ...")
-    with ProcessPoolExecutor(n_workers) as executor:
-        futures = [executor.submit(feature_fn, f) for f in test_files]
-        for future in tqdm(futures):
-            name, data, feature = future.result()
-            data_dict[name] = enc(data).astype(np.uint8)
-            data_dict[name + '_h'] = feature
-    np.savez(test_data, **data_dict)
-
-    calc_stats(train_data, out_dir)
-
-
-def _process_wav(file_list, outfile, winlen, winstep, n_mcep, mcep_alpha, minf0, maxf0, q_channels, type):
-    data_dict = {}
+    for split, split_files in (('train', train_files), ('test', test_files)):
+        print("Processing", split, "data ...")
+        n_cached = 0
+        with ProcessPoolExecutor(n_workers) as executor, Packed_Writer(out_dir, split, feature_dtype, resume=resume,
+                                                                       meta=params) as writer:
+            done = set(writer.names)
+            todo = [f for f in split_files if os.path.basename(f).replace(".wav", "") not in done]
+            if len(todo) < len(split_files):
+                print("Resuming after", len(split_files) - len(todo), "files.")
+            progress = tqdm(total=len(split_files), initial=len(split_files) - len(todo))
+
+            def collect(futures):
+                n = 0
+                for future in futures:
+                    name, data, feature, stats, cached = future.result()
+                    writer.add(name, data, feature, stats)
+                    n += cached
+                    progress.update()
+                return n
+
+            pending = set()
+            for f in todo:
+                if len(pending) == 2 * n_workers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    n_cached += collect(finished)
+                pending.add(executor.submit(feature_fn, f))
+            n_cached += collect(as_completed(pending))
+            progress.close()
+        print(n_cached, "files from cache,", len(todo) - n_cached, "computed.")
+
+    calc_stats(out_dir, out_dir)
+
+
+def _process_wav(file_list, out_dir, split, winlen, winstep, n_mcep, mcep_alpha, minf0, maxf0, q_channels, type):
     enc = encoder(q_channels)
+    writer = Packed_Writer(out_dir, split)
     for f in tqdm(file_list):
         wav, sr = load(f, sr=None)
 
@@ -118,17 +233,14 @@ def _process_wav(file_list, outfile, winlen, winstep, n_mcep, mcep_alpha, minf0,
         wav = enc(x).astype(np.uint8)
 
         id = os.path.basename(f).replace(".wav", "")
-        data_dict[id] = wav
-        data_dict[id + "_h"] = h
-    np.savez(outfile, **data_dict)
+        writer.add(id, wav, h)
+    writer.close()
 
 
 def preprocess(wav_dir, output, **kwargs):
     in_dir = os.path.join(wav_dir)
     out_dir = os.path.join(output)
     # print(in_dir, out_dir)
-    train_data = os.path.join(out_dir, 'train.npz')
-    test_data = os.path.join(out_dir, 'test.npz')
     os.makedirs(out_dir, exist_ok=True)
 
     files = [os.path.join(in_dir, f) for f in os.listdir(in_dir)]
@@ -136,10 +248,10 @@ def preprocess(wav_dir, output, **kwargs):
     train_files = files[:1032]
     test_files = files[1032:]
 
-    _process_wav(train_files, train_data, **kwargs)
-    _process_wav(test_files, test_data, **kwargs)
+    _process_wav(train_files, out_dir, 'train', **kwargs)
+    _process_wav(test_files, out_dir, 'test', **kwargs)
 
-    calc_stats(train_data, out_dir)
+    calc_stats(out_dir, out_dir)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+import json
+import torch
+from time import perf_counter
+
+
+def conv_flops(conv, out):
+    # multiply-adds of a Conv1d that produced out
+    return 2 * out.numel() * conv.in_channels * conv.kernel_size[0] // conv.groups
+
+
+def linear_flops(linear, out):
+    return 2 * out.numel() * linear.in_features
+
+
+def _nbytes(out):
+    if torch.is_tensor(out):
+        return out.numel() * out.element_size()
+    if isinstance(out, (tuple, list)):
+        return sum(_nbytes(x) for x in out)
+    return 0
+
+
+def _run(name, fn, *args, flops=None):
+    # what the models call when no profiler is attached
+    return fn(*args)
+
+
+class Profiler:
+    """Record wall time, FLOPs and allocated bytes of every operation run through it.
+
+    Attach it with general_FFTNet.set_profiler, then each layer reports W_lr, V_lr and W_o separately, and the
+    generation loop also reports the buffer shift of each layer, fc_out and sampling. Events are grouped by
+    category, 'forward' for training and 'generate' for one_sample_generate.
+    flops: an estimate computed from the layer shapes. bytes: size of the tensors the operation returned.
+    sync: synchronize cuda around every operation so the times are not just the kernel launches, defaults to
+    whether cuda is available.
+    """
+
+    def __init__(self, sync=None):
+        self.sync = torch.cuda.is_available() if sync is None else sync
+        self.category = 'forward'
+        self.events = []
+        self.origin = perf_counter()
+
+    def reset(self):
+        self.events = []
+        self.origin = perf_counter()
+
+    def __call__(self, name, fn, *args, flops=None):
+        """Run fn(*args) as the operation name, flops is a number or a function of the output."""
+        if self.sync:
+            torch.cuda.synchronize()
+        start = perf_counter()
+        out = fn(*args)
+        if self.sync:
+            torch.cuda.synchronize()
+        duration = perf_counter() - start
+        if callable(flops):
+            flops = flops(out)
+        self.events.append((self.category, name, start - self.origin, duration, flops or 0, _nbytes(out)))
+        return out
+
+    def summary(self):
+        """Totals per (category, name) in order of first appearance, as a list of dicts."""
+        rows = {}
+        for category, name, _, duration, flops, nbytes in self.events:
+            row = rows.setdefault((category, name), {'category': category, 'name': name, 'calls': 0, 'time': 0.,
+                                                     'flops': 0, 'bytes': 0})
+            row['calls'] += 1
+            row['time'] += duration
+            row['flops'] += flops
+            row['bytes'] += nbytes
+        return list(rows.values())
+
+    def table(self):
+        """The summary formatted as a text table, with each operation's share of its category's time."""
+        rows = self.summary()
+        totals = {}
+        for row in rows:
+            totals[row['category']] = totals.get(row['category'], 0.) + row['time']
+        width = max([len(row['name']) for row in rows] + [4])
+        lines = ['{:<8} {:<{w}} {:>8} {:>11} {:>10} {:>7} {:>10} {:>11}'.format(
+            'category', 'name', 'calls', 'total ms', 'mean us', '%', 'GFLOP/s', 'MB', w=width)]
+        for row in rows:
+            lines.append('{:<8} {:<{w}} {:>8d} {:>11.3f} {:>10.2f} {:>7.2f} {:>10.3f} {:>11.3f}'.format(
+                row['category'], row['name'], row['calls'], row['time'] * 1e3, row['time'] / row['calls'] * 1e6,
+                100 * row['time'] / totals[row['category']] if totals[row['category']] > 0 else 0.,
+                row['flops'] / row['time'] / 1e9 if row['time'] > 0 else 0., row['bytes'] / 2 ** 20, w=width))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, filename):
+        """Write the events in the Chrome trace format, open it in chrome://tracing or Perfetto."""
+        events = [{'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': 0,
+                   'tid': 0, 'args': {'flops': flops, 'bytes': nbytes}}
+                  for category, name, start, duration, flops, nbytes in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
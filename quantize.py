@@ -0,0 +1,97 @@
+import torch
+import torch.nn.functional as F
+import os
+import argparse
+import numpy as np
+from scipy.interpolate import interp1d
+from datetime import datetime
+
+from incremental import Incremental_FFTNet
+from dataset import Packed_Corpus
+from checkpoint import load_network
+
+parser = argparse.ArgumentParser(description='Compare int8 and float generation of a trained FFTNet. int8 is '
+                                             'meant for batched generation, it is slower at batch size 1.')
+parser.add_argument('--model_file', type=str, default='slt_fftnet.pth')
+parser.add_argument('--data_dir', type=str, default='slt_mcc_data')
+parser.add_argument('--window_step', type=float, default=0.01)
+parser.add_argument('--interp_method', type=str, default='linear')
+parser.add_argument('--nll_utterances', type=int, default=16, help='number of test utterances to compute NLL on.')
+parser.add_argument('--nll_samples', type=int, default=4000, help='number of samples per utterance for NLL.')
+parser.add_argument('--speed_samples', type=int, default=8000, help='number of samples to generate for speed.')
+parser.add_argument('--batch_size', type=int, default=16, help='batch size of the batched speed test.')
+parser.add_argument('--threads', type=int, default=1, help='number of intra-op threads.')
+
+sampling_rate = 16000
+
+
+def load_test_set(data_dir, hopsize, interp_method, max_utterances):
+    scaler_info = np.load(os.path.join(data_dir, 'scaler.npz'))
+    corpus = Packed_Corpus(data_dir, 'test')
+    audio, features = [], []
+    for i in sorted(range(len(corpus)), key=lambda i: corpus.names[i])[:max_utterances]:
+        h = (corpus.features(i).T - scaler_info['mean']) / scaler_info['scale']
+        if interp_method == 'linear':
+            xx = np.arange(h.shape[0]) * hopsize
+            h = interp1d(xx, h, copy=False, axis=0)(np.arange(xx[-1]))
+        else:
+            h = np.repeat(h, hopsize, axis=0)
+        length = min(len(h), len(corpus.audio(i)))
+        audio.append(torch.from_numpy(corpus.audio(i)[:length].astype(int)))
+        features.append(torch.from_numpy(h[:length].T).float())
+    return audio, features
+
+
+def teacher_forced_nll(engine, audio, h):
+    """Average negative log likelihood of audio (B, M) given the true past, with conditioning h (B, aux, M)."""
+    p = engine.predict_dist
+    engine.init_buf(audio.size(0))
+    # the conditioning of a step is taken at the samples it predicts
+    engine.condition(h[:, :, p:])
+    total, count = 0., 0
+    with torch.no_grad():
+        for t in range(0, audio.size(1) - 2 * p + 1, p):
+            logits = engine.step(audio[:, t:t + p])
+            target = audio[:, t + p:t + 2 * p]
+            total += F.cross_entropy(logits.reshape(-1, logits.size(-1)), target.reshape(-1), reduction='sum').item()
+            count += target.numel()
+    return total / count
+
+
+def speed(fn, n):
+    a = datetime.now()
+    fn()
+    return n / (datetime.now() - a).total_seconds()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    net = load_network(args.model_file)
+    net.eval()
+
+    hopsize = int(sampling_rate * args.window_step)
+    audio, features = load_test_set(args.data_dir, hopsize, args.interp_method,
+                                     max(args.nll_utterances, args.batch_size))
+    engines = {'float': Incremental_FFTNet(net)}
+    engines['int8'] = engines['float'].quantized()
+
+    M = min(args.nll_samples, min(len(x) for x in audio[:args.nll_utterances]))
+    nll_audio = torch.stack([x[:M] for x in audio[:args.nll_utterances]])
+    nll_features = torch.stack([h[:, :M] for h in features[:args.nll_utterances]])
+    batch = [h[:, :args.speed_samples] for h in features[:args.batch_size]]
+
+    results = {}
+    for name, engine in engines.items():
+        results[name] = {
+            'nll': teacher_forced_nll(engine, nll_audio, nll_features),
+            'speed': speed(lambda: engine.generate(h=features[0][:, :args.speed_samples], c=2.),
+                           features[0][:, :args.speed_samples].size(1)),
+            'batch_speed': speed(lambda: engine.batch_generate(batch, c=2.), sum(h.size(1) for h in batch)),
+        }
+        print(name, "NLL: {:.4f}, speed: {:.1f} samples/sec, batch of {} speed: {:.1f} samples/sec.".format(
+            results[name]['nll'], results[name]['speed'], len(batch), results[name]['batch_speed']))
+
+    print("NLL difference: {:+.4f}".format(results['int8']['nll'] - results['float']['nll']))
+    print("Speedup: {:.2f}x, batched: {:.2f}x".format(results['int8']['speed'] / results['float']['speed'],
+                                                      results['int8']['batch_speed'] / results['float']['batch_speed']))
@@ -0,0 +1,84 @@
+import torch
+
+
+class Sampler:
+    """Draw classes from generation logits without building distribution objects.
+
+    method: 'sampling' (or 'gumbel') adds Gumbel noise to the logits and takes the argmax, 'cdf' inverts the
+    cumulative softmax with one uniform number per sample, 'argmax' takes the most likely class.
+    greedy: optional bool sequence, utterances of the batch marked True always take the argmax.
+    Random numbers are drawn block_size steps at a time from a torch.Generator seeded with seed, and all
+    intermediate tensors are allocated once, so a call does not allocate new tensors. The returned samples are a
+    buffer that the next call overwrites.
+    """
+
+    def __init__(self, batch_size, predict_dist, classes, *, method='sampling', greedy=None, seed=None,
+                 block_size=256, device='cpu'):
+        self.method = method
+        self.block_size = block_size
+        self.generator = torch.Generator(device=device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+        self.greedy = None if greedy is None else torch.tensor(greedy, dtype=torch.bool, device=device)
+        if self.greedy is not None and not self.greedy.any():
+            self.greedy = None
+
+        shape = (batch_size, predict_dist, classes)
+        self.scaled = torch.empty(shape, device=device)
+        self.cdf = torch.empty(shape, device=device)
+        self.target = torch.empty(batch_size, predict_dist, 1, device=device)
+        self.values = torch.empty(batch_size, predict_dist, device=device)
+        self.indices = torch.empty(batch_size, predict_dist, dtype=torch.long, device=device)
+        self.cdf_indices = torch.empty(batch_size, predict_dist, 1, dtype=torch.long, device=device)
+        self.blocks = {}
+
+    def shrink(self, batch_size):
+        """Keep only the first batch_size utterances of the batch."""
+        for name in ('scaled', 'cdf', 'target', 'values', 'indices', 'cdf_indices'):
+            setattr(self, name, getattr(self, name)[:batch_size])
+        if self.greedy is not None:
+            self.greedy = self.greedy[:batch_size]
+        for block in self.blocks.values():
+            block[0] = block[0][:, :batch_size]
+
+    def _noise(self, method):
+        # next step of pre-drawn random numbers, a new block is drawn when the current one is used up
+        block = self.blocks.get(method)
+        if block is None or block[1] == block[0].size(0):
+            size = (self.block_size,) + (self.target.shape if method == 'cdf' else self.scaled.shape)
+            noise = torch.rand(size, generator=self.generator, device=self.scaled.device)
+            if method != 'cdf':
+                noise = noise.log_().neg_().log_().neg_()
+                if self.greedy is not None:
+                    noise[:, self.greedy] = 0.
+            block = self.blocks[method] = [noise, 0]
+        block[1] += 1
+        return block[0][block[1] - 1]
+
+    def __call__(self, logits, c=1., method=None):
+        """logits: (B, predict_dist, classes), c: a float or a tensor broadcastable to the logits.
+
+        Returns the sampled classes of shape (B, predict_dist).
+        """
+        method = self.method if method is None else method
+        torch.mul(logits, c, out=self.scaled)
+        if method == 'argmax':
+            torch.max(self.scaled, -1, out=(self.values, self.indices))
+            return self.indices
+        if method == 'cdf':
+            torch.max(self.scaled, -1, keepdim=True, out=(self.target, self.cdf_indices))
+            if self.greedy is not None:
+                self.indices.copy_(self.cdf_indices.squeeze(-1))
+            self.scaled.sub_(self.target).exp_()
+            torch.cumsum(self.scaled, -1, out=self.cdf)
+            torch.mul(self.cdf[..., -1:], self._noise(method), out=self.target)
+            torch.searchsorted(self.cdf, self.target, right=True, out=self.cdf_indices)
+            self.cdf_indices.clamp_(max=self.cdf.size(-1) - 1)
+            if self.greedy is None:
+                return self.cdf_indices.squeeze(-1)
+            return torch.where(self.greedy.view(-1, 1), self.indices, self.cdf_indices.squeeze(-1))
+        self.scaled.add_(self._noise(method))
+        torch.max(self.scaled, -1, out=(self.values, self.indices))
+        return self.indices
@@ -0,0 +1,104 @@
+from collections import deque
+from itertools import repeat
+
+import numpy as np
+import torch
+
+from incremental import Incremental_FFTNet
+from utils import decoder
+
+
+class Frame_Upsampler:
+    """Upsample feature frames to the sample rate as they arrive.
+
+    'linear' gives the same columns as interpolating the whole utterance with interp1d on frames placed every
+    hopsize samples: the samples between two frames are emitted once the second one arrives.
+    'repeat' emits hopsize copies of each frame right away.
+    """
+
+    def __init__(self, hopsize, interp_method='linear'):
+        if interp_method not in ('linear', 'repeat'):
+            raise ValueError("interpolation method " + interp_method + " is not implemented.")
+        self.hopsize = hopsize
+        self.interp_method = interp_method
+        self.last_frame = None
+        self.ramp = np.arange(hopsize)
+
+    def push(self, frames):
+        """frames: array of shape (feature_dim,) or (feature_dim, k). Returns the new columns (feature_dim, n)."""
+        frames = np.asarray(frames).reshape(len(frames), -1)
+        if self.interp_method == 'repeat':
+            return np.repeat(frames, self.hopsize, axis=1)
+
+        if self.last_frame is not None:
+            frames = np.concatenate((self.last_frame, frames), axis=1)
+        self.last_frame = frames[:, -1:]
+        y_lo, y_hi = frames[:, :-1, None], frames[:, 1:, None]
+        columns = (y_hi - y_lo) / self.hopsize * self.ramp + y_lo
+        return columns.reshape(len(frames), -1)
+
+
+def stream_generate(net, frames, hopsize, *, interp_method='linear', c=1., method='sampling', seed=None,
+                    chunk_size=1600):
+    """Vocode conditioning frames as they arrive.
+
+    frames: iterable of normalized feature frames of shape (aux_channels,), or blocks of shape (aux_channels, k).
+    c: constant multiplied before softmax, a float or an iterable with one value per frame.
+    method, seed: see sampling.Sampler.
+    Yields mu-law decoded audio chunks of chunk_size samples, the last one may be shorter. Only the history the
+    network needs is kept, so memory does not grow with the input length.
+    """
+    device = next(net.parameters()).device
+    pred_dist = net.get_predict_distance()
+    engine = Incremental_FFTNet(net)
+    engine.init_buf(seed=seed)
+    upsampler = Frame_Upsampler(hopsize, interp_method)
+    dec = decoder(net.classes)
+
+    chunk = torch.empty(chunk_size, dtype=torch.long, device=device)
+    samples = torch.zeros(1, pred_dist, dtype=torch.long, device=device)
+    filled = total = 0
+    # constants of the upsampled segments that are not fully generated yet, the first one is segment first_seg
+    seg_c = deque()
+    first_seg = 0
+
+    def generate():
+        nonlocal samples, filled, first_seg
+        while engine.written < total and engine.written + pred_dist <= engine.cond_available:
+            t = engine.written
+            while t >= (first_seg + 1) * hopsize:
+                seg_c.popleft()
+                first_seg += 1
+            samples = engine.sampler(engine.step(samples), seg_c[0], method)
+
+            n, k = min(pred_dist, total - t), 0
+            while k < n:
+                m = min(n - k, chunk_size - filled)
+                chunk[filled:filled + m] = samples[0, k:k + m]
+                filled += m
+                k += m
+                if filled == chunk_size:
+                    yield dec(chunk)
+                    filled = 0
+
+    cs = repeat(c) if not hasattr(c, '__iter__') else c
+    aux_channels = None
+    with torch.no_grad():
+        for frame, frame_c in zip(frames, cs):
+            frame = np.asarray(frame).reshape(len(frame), -1)
+            aux_channels = frame.shape[0]
+            # segment k of the upsampled conditioning starts at frame k for both methods
+            seg_c.extend([frame_c] * frame.shape[1])
+            columns = upsampler.push(frame)
+            if not columns.shape[1]:
+                continue
+            engine.extend_condition(torch.from_numpy(columns).float().unsqueeze(0).to(device))
+            total += columns.shape[1]
+            yield from generate()
+
+        if aux_channels is None:
+            return
+        engine.extend_condition(torch.zeros(1, aux_channels, 0, device=device), last=True)
+        yield from generate()
+        if filled:
+            yield dec(chunk[:filled])
@@ -1,12 +1,21 @@
 import torch
 from torch.utils.data import DataLoader
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 import argparse
 import os
+import socket
+import resource
+from time import perf_counter
+from multiprocessing import get_context
 
 from preprocess import preprocess_cmu
 from models import general_FFTNet
-from dataset import CMU_Dataset
+from dataset import CMU_Window_Batches
+from checkpoint import Checkpointer, load_checkpoint
+from metrics import Training_Metrics
 from datetime import datetime
 
 parser = argparse.ArgumentParser()
@@ -23,7 +32,10 @@ parser.add_argument('--window_length', type=float, default=0.025)
 parser.add_argument('--window_step', type=float, default=0.01)
 parser.add_argument('--minimum_f0', type=float, default=71)
 parser.add_argument('--maximum_f0', type=float, default=800)
+parser.add_argument('--f0_method', type=str, default='harvest', help='harvest or dio, dio is much faster.')
 parser.add_argument('--q_channels', type=int, default=256, help='quantization channels')
+parser.add_argument('--feature_dtype', type=str, default='float32', help='float32 or float16, storage type of '
+                                                                          'the preprocessed features.')
 parser.add_argument('--interp_method', type=str, default='linear')
 parser.add_argument('--fft_channels', type=int, default=128, help='fftnet layer channels')
 parser.add_argument('--seq_M', type=int, default=5000, help='training sequence length')
@@ -32,75 +44,321 @@ parser.add_argument('--batch_size', type=int, default=5)
 parser.add_argument('--lr', type=float, default=0.001, help='learning rate')
 parser.add_argument('--steps', type=int, default=100000, help='iteration number')
 parser.add_argument('--injected_noise', action='store_true')
+parser.add_argument('--steps_per_epoch', type=int, default=1000, help='number of batches drawn per epoch.')
+parser.add_argument('--weighted_sampling', action='store_true', help='draw utterances proportionally to their length.')
+parser.add_argument('--num_workers', type=int, default=1, help='number of data loading processes.')
 parser.add_argument('--model_file', type=str, default='slt_fftnet')
 parser.add_argument('--checkpoint_dir', type=str, default='checkpoints/',
                     help='Directory to save checkpoints.')
 parser.add_argument('--checkpoint_step', type=int, default=5000)
+parser.add_argument('--keep_checkpoints', type=int, default=5, help='number of latest checkpoints kept.')
+parser.add_argument('--resume', action='store_true', help='continue from the latest checkpoint in checkpoint_dir.')
+parser.add_argument('--log_step', type=int, default=100, help='report the mean loss and the training speed every '
+                                                             'log_step steps.')
+parser.add_argument('--metrics_file', type=str, default=None, help='also write the reports to it, as csv if it ends '
+                                                                   'with .csv, else as json lines.')
 parser.add_argument('--transpose', action='store_true')
 parser.add_argument('--predict_dist', type=int, default=1)
+parser.add_argument('--device', type=str, default=None, help='default: cuda if available, else cpu.')
+parser.add_argument('--amp', type=str, default='none', help='mixed precision: none, bf16, or fp16 (cuda only, with '
+                                                            'loss scaling).')
+parser.add_argument('--precision_report', action='store_true', help='compare the step time and memory of fp32 and '
+                                                                    'mixed precision training, then exit.')
+parser.add_argument('--report_steps', type=int, default=20, help='number of timed steps of --precision_report, '
+                                                                 '--scaling_report and --memory_report.')
+parser.add_argument('--recompute', type=int, default=0, help='recompute the activations of groups of this many fft '
+                                                             'layers in backward instead of keeping them, 0: keep all.')
+parser.add_argument('--loss_chunk', type=int, default=1024, help='compute the output layer and the loss over chunks '
+                                                                'of this many steps, 0: in one go.')
+parser.add_argument('--memory_report', action='store_true', help='compare the step time and memory of the '
+                                                                 '--report_recompute modes at every --report_seq_M, '
+                                                                 'then exit.')
+parser.add_argument('--report_seq_M', nargs='+', type=int, default=[5000, 10000, 20000])
+parser.add_argument('--report_recompute', nargs='+', type=int, default=[0, 1, 3])
+parser.add_argument('--distributed', type=int, default=1, help='number of local training processes. Also started '
+                                                               'by torchrun, which sets WORLD_SIZE and RANK.')
+parser.add_argument('--backend', type=str, default=None, help='torch.distributed backend, default nccl with cuda, '
+                                                              'else gloo.')
+parser.add_argument('--scaling_report', action='store_true', help='report the training speed of 1 to --distributed '
+                                                                  'processes, then exit.')
+parser.add_argument('--seed', type=int, default=None, help='random seed, offset by the rank of each process.')
+
+amp_dtypes = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def get_device(args, local_rank=0):
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', local_rank % torch.cuda.device_count())
+    return device
+
+
+def init_distributed(rank, world_size, args):
+    """Join the process group of a distributed run, returns the device of this process."""
+    local_rank = int(os.environ.get('LOCAL_RANK', rank))
+    device = get_device(args, local_rank)
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    if world_size > 1:
+        if device.type == 'cpu':
+            # the processes share the cores of the machine
+            torch.set_num_threads(max(1, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', world_size))))
+        dist.init_process_group(args.backend or ('nccl' if device.type == 'cuda' else 'gloo'), rank=rank,
+                                world_size=world_size)
+    return device
+
+
+def _local_master():
+    # address of rank 0 for processes started by spawn
+    if 'MASTER_PORT' not in os.environ:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            os.environ['MASTER_PORT'] = str(s.getsockname()[1])
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+
+
+def build_model(args, device):
+    model = general_FFTNet(radixs=args.radixs, fft_channels=args.fft_channels, classes=args.q_channels,
+                           aux_channels=args.feature_dim + 1, transpose=args.transpose, predict_dist=args.predict_dist)
+    model.set_recompute(args.recompute)
+    return model.to(device)
+
+
+def get_scaler(amp, device):
+    # fp16 gradients underflow without loss scaling, bf16 has the range of fp32
+    if amp not in amp_dtypes:
+        raise ValueError("mixed precision mode " + amp + " is not implemented.")
+    if amp == 'fp16':
+        if device.type != 'cuda':
+            raise ValueError("fp16 training needs cuda, use bf16 on cpu.")
+        return torch.amp.GradScaler('cuda')
+    return None
+
+
+def train_step(net, batch, optimizer, device, amp='none', scaler=None, loss_chunk=1024):
+    inputs, targets, features = (x.to(device, non_blocking=True) for x in batch)
+    optimizer.zero_grad()
+    with torch.autocast(device.type, dtype=amp_dtypes[amp], enabled=amp != 'none'):
+        # cross entropy computed by the model over chunks of loss_chunk steps, without the logits of the whole batch
+        loss = net(inputs, features, targets=targets, loss_chunk=loss_chunk)
+    if scaler is not None:
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    else:
+        loss.backward()
+        optimizer.step()
+    return loss
+
+
+def _measure_step(args, amp):
+    # time report_steps training steps on random batches, in a fresh process so that peak memory is its own
+    device = get_device(args)
+    torch.manual_seed(0)
+    net = build_model(args, device)
+    optimizer = torch.optim.Adam(net.parameters(), lr=args.lr)
+    scaler = get_scaler(amp, device)
+    batch = (torch.randint(args.q_channels, (args.batch_size, args.seq_M)),
+             torch.randint(args.q_channels, (args.batch_size, args.seq_M)),
+             torch.randn(args.batch_size, args.feature_dim + 1, args.seq_M))
+    for _ in range(3):
+        train_step(net, batch, optimizer, device, amp, scaler, args.loss_chunk)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    a = perf_counter()
+    for _ in range(args.report_steps):
+        loss = train_step(net, batch, optimizer, device, amp, scaler, args.loss_chunk)
+    loss = loss.item()
+    cost = (perf_counter() - a) / args.report_steps
+    if device.type == 'cuda':
+        memory = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        # kilobytes on linux
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return cost, memory, loss
+
+
+def _measure_scaling(rank, world_size, args, queue):
+    device = init_distributed(rank, world_size, args)
+    torch.manual_seed(rank)
+    net = build_model(args, device)
+    if world_size > 1:
+        net = DistributedDataParallel(net, device_ids=[device] if device.type == 'cuda' else None)
+    optimizer = torch.optim.Adam(net.parameters(), lr=args.lr)
+    batch = (torch.randint(args.q_channels, (args.batch_size, args.seq_M)),
+             torch.randint(args.q_channels, (args.batch_size, args.seq_M)),
+             torch.randn(args.batch_size, args.feature_dim + 1, args.seq_M))
+    for _ in range(3):
+        train_step(net, batch, optimizer, device, args.amp, loss_chunk=args.loss_chunk)
+    if world_size > 1:
+        dist.barrier()
+    a = perf_counter()
+    for _ in range(args.report_steps):
+        loss = train_step(net, batch, optimizer, device, args.amp, loss_chunk=args.loss_chunk)
+    loss.item()
+    if world_size > 1:
+        dist.barrier()
+        dist.destroy_process_group()
+    if rank == 0:
+        queue.put(args.report_steps / (perf_counter() - a))
+
+
+def scaling_report(args):
+    _local_master()
+    ctx = mp.get_context('spawn')
+    print("Batch size {} per process, seq_M {}.".format(args.batch_size, args.seq_M))
+    speeds = []
+    for world_size in range(1, args.distributed + 1):
+        queue = ctx.SimpleQueue()
+        mp.spawn(_measure_scaling, args=(world_size, args, queue), nprocs=world_size)
+        speeds.append(queue.get())
+        print("{} processes: {:.2f} steps/sec, {:.1f} samples/sec, {:.2f}x speedup, {:.0f}% scaling efficiency, "
+              "{:+.1f} samples/sec from the last process".format(
+                  world_size, speeds[-1], speeds[-1] * world_size * args.batch_size * args.seq_M,
+                  speeds[-1] * world_size / speeds[0], 100 * speeds[-1] / speeds[0],
+                  (speeds[-1] * world_size - (speeds[-2] * (world_size - 1) if world_size > 1 else 0))
+                  * args.batch_size * args.seq_M))
+
+
+def precision_report(args):
+    device = get_device(args)
+    modes = ['none', 'bf16'] + (['fp16'] if device.type == 'cuda' else [])
+    print("Batch size {}, seq_M {} on {}, peak memory is {}.".format(
+        args.batch_size, args.seq_M, device, 'allocated by cuda' if device.type == 'cuda' else 'process RSS'))
+    results = {}
+    for amp in modes:
+        with get_context('spawn').Pool(1) as pool:
+            results[amp] = pool.apply(_measure_step, (args, amp))
+        cost, memory, loss = results[amp]
+        print("{:>4}: {:.1f} ms/step ({:.2f}x), peak memory {:.1f} MB ({:.2f}x), loss {:.4f}".format(
+            amp, cost * 1000, results['none'][0] / cost, memory, memory / results['none'][1], loss))
+
+
+def memory_report(args):
+    device = get_device(args)
+    print("Batch size {}, {} layers on {}, peak memory is {}.".format(
+        args.batch_size, len(args.radixs), device, 'allocated by cuda' if device.type == 'cuda' else 'process RSS'))
+    for seq_M in args.report_seq_M:
+        results = {}
+        for recompute in args.report_recompute:
+            report_args = argparse.Namespace(**vars(args))
+            report_args.seq_M, report_args.recompute = seq_M, recompute
+            with get_context('spawn').Pool(1) as pool:
+                results[recompute] = pool.apply(_measure_step, (report_args, args.amp))
+            cost, memory, loss = results[recompute]
+            base_cost, base_memory, _ = results[args.report_recompute[0]]
+            print("seq_M {:6d}, recompute {}: {:.1f} ms/step ({:.2f}x), peak memory {:.1f} MB ({:.2f}x)".format(
+                seq_M, recompute, cost * 1000, cost / base_cost, memory, memory / base_memory))
 
 
 def main():
     args = parser.parse_args()
+    if args.precision_report:
+        precision_report(args)
+        return
+    if args.memory_report:
+        memory_report(args)
+        return
+    if args.scaling_report:
+        scaling_report(args)
+        return
+    if 'WORLD_SIZE' in os.environ:
+        # started by torchrun, preprocess the data beforehand
+        train(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), args)
+        return
+
     if args.preprocess:
         print('==> Preprocessing data ...')
         preprocess_cmu(args.wav_dir, args.data_dir, q_channels=args.q_channels, winlen=args.window_length,
                        winstep=args.window_step, n_mcep=args.feature_dim, mcep_alpha=args.mcep_alpha,
-                       minf0=args.minimum_f0, maxf0=args.maximum_f0, type=args.feature_type)
-
-    print('==> Loading Dataset..')
-    training_dataset = CMU_Dataset(args.data_dir, args.seq_M, args.q_channels, int(16000 * args.window_step),
-                                   args.interp_method, injected_noise=args.injected_noise,
-                                   predict_dist=args.predict_dist)
-    training_loader = DataLoader(training_dataset, batch_size=args.batch_size, num_workers=4, shuffle=True)
-
-    print('==> Building model..')
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    net = general_FFTNet(radixs=args.radixs, fft_channels=args.fft_channels, classes=args.q_channels,
-                         aux_channels=args.feature_dim + 1, transpose=args.transpose,
-                         predict_dist=args.predict_dist).to(device)
-
-    if torch.cuda.device_count() > 1:
-        net = torch.nn.DataParallel(net)
-    if device == 'cuda':
-        cudnn.benchmark = True
+                       minf0=args.minimum_f0, maxf0=args.maximum_f0, type=args.feature_type,
+                       feature_dtype=args.feature_dtype, f0_method=args.f0_method)
+    if args.distributed > 1:
+        _local_master()
+        mp.spawn(train, args=(args.distributed, args), nprocs=args.distributed)
+    else:
+        train(0, 1, args)
 
-    print(sum(p.numel() for p in net.parameters() if p.requires_grad), "of parameters.")
 
-    criterion = torch.nn.CrossEntropyLoss()
-    optimizer = torch.optim.Adam(net.parameters(), lr=args.lr)
+def train(rank, world_size, args):
+    """Training loop of one process, rank 0 alone reports the loss and saves the model and checkpoints."""
+    device = init_distributed(rank, world_size, args)
+    if args.seed is not None:
+        torch.manual_seed(args.seed + rank)
+    log = print if rank == 0 else (lambda *x: None)
+
+    log('==> Building model..')
+    model = build_model(args, device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    scaler = get_scaler(args.amp, device)
+    checkpointer = Checkpointer(args.checkpoint_dir, args.model_file, args.keep_checkpoints)
 
-    os.makedirs(args.checkpoint_dir, exist_ok=True)
-    print("Start Training.")
-    a = datetime.now().replace(microsecond=0)
     global_step = 0
-    while global_step < args.steps:
-        for batch_idx, (inputs, targets, features) in enumerate(training_loader):
-            inputs, targets, features = inputs.cuda(), targets.cuda(), features.cuda()
+    seed = args.seed
+    path = checkpointer.latest() if args.resume else None
+    if path is not None:
+        state = load_checkpoint(path, model, optimizer, scaler)
+        global_step, seed = state['step'], state['extra']['seed']
+        log("Resuming from", path)
+    elif seed is None:
+        # every rank takes the seed of rank 0
+        seed = [int.from_bytes(os.urandom(4), 'little')]
+        if world_size > 1:
+            dist.broadcast_object_list(seed)
+        seed = seed[0]
+
+    net = model
+    if world_size > 1:
+        # the parameters of rank 0 are broadcast to the others here
+        net = DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None)
+    if device.type == 'cuda':
+        cudnn.benchmark = True
+
+    log(sum(p.numel() for p in net.parameters() if p.requires_grad), "of parameters.")
+    if world_size > 1:
+        log("Training on", world_size, "processes, global batch size", world_size * args.batch_size)
 
-            optimizer.zero_grad()
+    log('==> Loading Dataset..')
+    # the batch of a step only depends on the seed and the step, so a resumed run reads the same batches
+    training_dataset = CMU_Window_Batches(args.data_dir, args.batch_size, args.seq_M, args.q_channels,
+                                          int(16000 * args.window_step), args.interp_method,
+                                          injected_noise=args.injected_noise, predict_dist=args.predict_dist,
+                                          steps_per_epoch=args.steps_per_epoch, weighted=args.weighted_sampling,
+                                          rank=rank, world_size=world_size, seed=seed)
 
-            logits = net(inputs, features)
-            loss = criterion(logits.unsqueeze(-1), targets.unsqueeze(-1))
-            loss.backward()
-            optimizer.step()
+    metrics = Training_Metrics(world_size * args.batch_size * args.seq_M, args.log_step, args.metrics_file)
 
-            print(global_step, "{:.4f}".format(loss.item()))
+    log("Start Training.")
+    a = datetime.now().replace(microsecond=0)
+    while global_step < args.steps:
+        # every item is a whole batch, the rest of the epoch is read
+        epoch_end = min((global_step // args.steps_per_epoch + 1) * args.steps_per_epoch, args.steps)
+        training_loader = DataLoader(training_dataset, batch_size=None, sampler=range(global_step, epoch_end),
+                                     num_workers=args.num_workers, pin_memory=device.type == 'cuda')
+        for batch in metrics.timed(training_loader):
+            loss = train_step(net, batch, optimizer, device, args.amp, scaler, args.loss_chunk)
+
+            if rank == 0:
+                metrics.step(global_step, loss)
             global_step += 1
-            if global_step > args.steps:
-                break
 
-            if global_step % args.checkpoint_step == 0:
-                model = net.module if isinstance(net, torch.nn.DataParallel) else net
-                torch.save(model, os.path.join(args.checkpoint_dir, args.model_file + "_{}.pth".format(global_step)))
+            if global_step % args.checkpoint_step == 0 and rank == 0:
+                # written in the background
+                checkpointer.save(global_step, model, optimizer, scaler, seed=seed)
                 print("Checkpoint saved.")
 
-    print("Training time cost:", datetime.now().replace(microsecond=0) - a)
-
-    net = net.module if isinstance(net, torch.nn.DataParallel) else net
+    if rank == 0:
+        metrics.report(global_step - 1)
+    log("Training time cost:", datetime.now().replace(microsecond=0) - a)
 
-    torch.save(net, args.model_file + ".pth")
-    print("Model saved to", args.model_file)
+    if rank == 0:
+        checkpointer.wait()
+        # the whole module, as decode.py loads it
+        torch.save(model, args.model_file + ".pth")
+        print("Model saved to", args.model_file)
+    if world_size > 1:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
@@ -59,6 +59,63 @@ def repeat_last_padding(x, maxlen):
         return np.concatenate((x, pad_value), axis=-1)
 
 
+class Running_Stats:
+    """Count, mean and sum of squared deviations (M2) per feature dimension, mergeable across processes.
+
+    Merging uses the pairwise update of Chan et al., so statistics gathered separately for parts of the data combine
+    to the statistics of the whole without another pass over it. scale matches StandardScaler.scale_.
+    """
+
+    def __init__(self, count=0, mean=None, m2=None):
+        self.count = int(count)
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = None if m2 is None else np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def from_array(cls, x):
+        """Statistics of x, of shape (frames, feature_dim)."""
+        x = np.asarray(x, dtype=np.float64)
+        mean = x.mean(0)
+        return cls(len(x), mean, ((x - mean) ** 2).sum(0))
+
+    def update(self, x):
+        self.merge(Running_Stats.from_array(x))
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / self.count
+
+    @property
+    def scale(self):
+        scale = np.sqrt(self.var)
+        # constant dimensions are left unscaled, like StandardScaler
+        scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.
+        return scale
+
+    def state_dict(self):
+        return {'count': self.count, 'mean': self.mean.tolist() if self.count else [],
+                'm2': self.m2.tolist() if self.count else []}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        if not state['count']:
+            return cls()
+        return cls(state['count'], state['mean'], state['m2'])
+
+
 # this function is copied from https://github.com/braindead/logmmse/blob/master/logmmse.py
 # change numpy to tensor
 